@@ -52,7 +52,7 @@ class ManyToManyDescriptor(object):
         superclass = self.superclass or self.target_model._default_manager.__class__
         cls = django_models.fields.related.create_many_related_manager(superclass, self.field.rel)
         if self.class_decorator:
-            cls = class_decorator(cls)
+            cls = self.class_decorator(cls)
         return cls(
             model=model,
             core_filters={'%s__pk' % self.query_name(): instance.pk},
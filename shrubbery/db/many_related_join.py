@@ -1,79 +1,364 @@
-from StringIO import StringIO
+import re
+import threading
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.constants import LOOKUP_SEP, TABLE_NAME
+from django.db.models.sql.where import AND, Constraint
+from django.db.models.sql.aggregates import Aggregate as SqlAggregate
 from shrubbery.db.utils import get_query_set, force_empty
-from shrubbery.utils import reduce_or
+from shrubbery.utils import reduce_or, LRUCache
 
-def cross_product(*lists):
-    result = [[]]
-    for seq in lists:
-        result = [res + [x] for res in result for x in seq]
-    return set(frozenset(res) for res in result)
+prefix_notation_cache = LRUCache(256)
+
+def iter_bits(mask):
+    """ Yields the single bit masks set in `mask`, lowest first. """
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+class TermTable(object):
+    """ 
+    Maps the terms of a boolean expression to bit positions. Tables only grow, so bits stay valid for copies of a table. 
+    Terms are identified by primary key, instances of `model` are only loaded when they are needed.
+    """
+    def __init__(self, model=None):
+        self.model = model
+        self.keys = []
+        self.ids = {}
+        self.instances = {}
+        self.lock = threading.Lock()
+        
+    def bit(self, term):
+        key = getattr(term, 'pk', term)
+        with self.lock:
+            if key is not term:
+                self.instances.setdefault(key, term)
+            index = self.ids.get(key)
+            if index is None:
+                index = self.ids[key] = len(self.keys)
+                self.keys.append(key)
+        return 1 << index
+        
+    def copy(self):
+        table = TermTable(self.model)
+        with self.lock:
+            table.keys = list(self.keys)
+            table.ids = dict(self.ids)
+            table.instances = dict(self.instances)
+        return table
+        
+    def mask(self, terms):
+        mask = 0
+        for term in terms:
+            mask |= self.bit(term)
+        return mask
+        
+    def get_keys(self, mask):
+        return [self.keys[bit.bit_length() - 1] for bit in iter_bits(mask)]
+        
+    def get_term(self, key):
+        return self.instances.get(key, key)
+        
+    def hydrate(self, keys):
+        # loads all missing instances with a single query
+        if not hasattr(self.model, '_meta'):
+            return
+        missing = [key for key in keys if key not in self.instances and not isinstance(key, SubqueryTerm)]
+        if missing:
+            self.instances.update(get_query_set(self.model).in_bulk(missing))
+        
+    def get_objects(self, mask):
+        keys = self.get_keys(mask)
+        self.hydrate(keys)
+        return [self.get_term(key) for key in keys]
+        
+    def key_literals(self, clause):
+        pos, neg = clause
+        return [(key, False) for key in self.get_keys(pos)] + [(key, True) for key in self.get_keys(neg)]
+        
+    def literals(self, clause):
+        pos, neg = clause
+        self.hydrate(self.get_keys(pos | neg))
+        return [(self.get_term(key), negated) for key, negated in self.key_literals(clause)]
+        
+
+class SubqueryTerm(object):
+    """ An opaque term that stands for a whole expression `q`, it is evaluated as a subquery. """
+    def __init__(self, q):
+        self.q = q
+        
+    def __unicode__(self):
+        return u"[%r]" % self.q
+        
+
+class ManyRelatedWhere(object):
+    """ 
+    A where node that tests each clause with correlated subqueries against the relation table, so it doesn't add any joins.
+    `clauses` is a list of `(positive pks, negated pks, nested)` tuples, `nested` is a list of `(negated, clauses)` for subexpressions.
+    """
+    def __init__(self, alias, column, relation, clauses):
+        self.alias = alias
+        self.column = column
+        self.relation = relation
+        self.clauses = clauses
+        
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+        
+    def as_sql(self, qn=None, connection=None):
+        table, source, target = self.relation
+        subquery = "SELECT %%s FROM %s mrj WHERE mrj.%s = %s.%s AND mrj.%s " % (qn(table), qn(source), qn(self.alias), qn(self.column), qn(target))
+        return self._as_sql(subquery, self.clauses)
+        
+    def _as_sql(self, subquery, clauses):
+        exists = subquery % "1"
+        conj, params = [], []
+        for pos, neg, nested in clauses:
+            disj = []
+            if pos:
+                disj.append("EXISTS (" + exists + "IN (%s))" % ", ".join(["%s"] * len(pos)))
+                params.extend(pos)
+            if len(neg) == 1:
+                disj.append("NOT EXISTS (" + exists + "= %s)")
+                params.extend(neg)
+            elif neg:
+                # (~a | ~b) <=> not all of a, b are related
+                disj.append("(" + subquery % "COUNT(*)" + "IN (%s)) < %s" % (", ".join(["%s"] * len(neg)), len(neg)))
+                params.extend(neg)
+            for negated, nested_clauses in nested:
+                sql, nested_params = self._as_sql(subquery, nested_clauses)
+                disj.append(negated and "NOT %s" % sql or sql)
+                params.extend(nested_params)
+            conj.append(" OR ".join(disj))
+        return "(%s)" % " AND ".join("(%s)" % disj for disj in conj), params
+        
+
+class ClauseMatchSql(SqlAggregate):
+    is_ordinal = True
     
-def _add(s, x, set_type):
-    if set_type:
-        x = set_type((x,))
-    return s.union((x,))
+    def as_sql(self, qn, connection):
+        if isinstance(self.col, (list, tuple)):
+            col = '.'.join([qn(c) for c in self.col])
+        else:
+            col = self.col
+        return "CASE WHEN %s THEN 1 ELSE 0 END" % self._as_sql(col, self.extra['clauses'])
+        
+    def _as_sql(self, col, clauses):
+        def count(pks):
+            return "SUM(CASE WHEN %s IN (%s) THEN 1 ELSE 0 END)" % (col, ", ".join("%d" % pk for pk in pks))
+        conj = []
+        for pos, neg, nested in clauses:
+            disj = []
+            if pos:
+                disj.append("%s > 0" % count(pos))
+            if neg:
+                # (~a | ~b) <=> not all of a, b are related
+                disj.append("%s < %s" % (count(neg), len(neg)))
+            for negated, nested_clauses in nested:
+                sql = self._as_sql(col, nested_clauses)
+                disj.append(negated and "NOT %s" % sql or sql)
+            conj.append(" OR ".join(disj))
+        return "(%s)" % " AND ".join("(%s)" % disj for disj in conj)
+            
+
+class ClauseMatch(models.Aggregate):
+    """ Annotates 1 for rows whose related values satisfy `clauses` (as returned by `ManyRelatedJoinQ._compile_clauses()`), 0 otherwise. """
+    name = 'ClauseMatch'
     
+    def add_to_query(self, query, alias, col, source, is_summary):
+        query.aggregates[alias] = ClauseMatchSql(col, source=source, is_summary=is_summary, **self.extra)
+        
+
+def _unique_aggregate_alias(query, prefix):
+    alias, n = prefix, 0
+    while alias in query.aggregates:
+        n += 1
+        alias = "%s_%s" % (prefix, n)
+    return alias
+
+def _is_joined(query, table):
+    return any(query.alias_map[alias][TABLE_NAME] == table for alias in query.tables if query.alias_refcount[alias])
+
+def _only_int_pks(clauses):
+    for pos, neg, nested in clauses:
+        for pk in pos + neg:
+            if not isinstance(pk, (int, long)):
+                return False
+        for negated, nested_clauses in nested:
+            if not _only_int_pks(nested_clauses):
+                return False
+    return True
+
 
 class ManyRelatedJoinQ(object):
-    " Stores a boolean expression of `lookup=obj` terms in conjunctive normal form."
+    """ 
+    Stores a boolean expression of `lookup=obj` terms in conjunctive normal form. 
+    Each clause (disjunction) is a pair of bitmasks `(positive, negative)` over the terms in `self.table`.
+    """
     model = None
     field = None
     lookup = 'exact'
     use_aggregation = True
+    use_subqueries = True
+    # Negations that would expand to more clauses fall back to a NOT IN subquery.
+    max_clauses = 64
 
     def __init__(self, obj=None, lookup=None, model=None):
         self.trivial = None
-        if obj:
-            self.conjunction = set([frozenset([(obj, False)])])
+        self.table = TermTable(self.model)
+        if obj is not None:
+            self.clauses = set([(self.table.bit(obj), 0)])
         else:
-            self.conjunction = set()
+            self.clauses = set()
 
     def q_for_obj(self, obj, negated=False, lookup=None):
         q = models.Q(**{"%s__%s" % (self.field, lookup or self.lookup): obj})
         if negated:
             q = ~q
         return q        
+        
+    def q_for_term(self, query, obj, negated=False):
+        if isinstance(obj, SubqueryTerm):
+            q = models.Q(pk__in=get_query_set(query.model).complex_filter(obj.q).values('pk'))
+            if negated:
+                q = ~q
+            return q
+        return self.q_for_obj(obj, negated)
 
     def add_to_query(self, query, aliases=None):
         if self.trivial:
             return
         elif self.trivial is False:
             force_empty(query)
-        elif self.use_aggregation and len(self.conjunction) > 1 and max(len(disj) for disj in self.conjunction) == 1 and not self.contains_negation():
-            conj = [iter(disj).next() for disj in self.conjunction]
-            query.add_q(reduce_or(self.q_for_obj(obj, negated) for obj, negated in conj))
+            return
+        clauses = self.lookup == 'exact' and self._compile_clauses(self.clauses, self.table)
+        # the grouped scan may restrict the related rows, so it can only be used once per query, 
+        # and it would reuse a join of the relation that other filters already restrict
+        relation = self.get_relation(query.model)
+        aggregated = any(isinstance(aggregate, ClauseMatchSql) for aggregate in query.aggregates.values())
+        joined = relation is not None and _is_joined(query, relation[0])
+        if self.use_aggregation and not aggregated and not joined and len(self.clauses) > 1 and clauses and _only_int_pks(clauses):
+            # a single grouped scan over the relation, clauses are tested with conditional sums in HAVING
             opts = query.model._meta
             if query.group_by is None:
                 field_names = [f.attname for f in opts.fields]
                 query.add_fields(field_names, False)
                 query.set_group_by()
-            query.add_aggregate(models.Count(self.field), query.model, 'mrj_count', is_summary=False)
-            query.add_q(models.Q(mrj_count=len(conj)))
+            match = _unique_aggregate_alias(query, 'mrj_match')
+            query.add_aggregate(ClauseMatch(self.field, clauses=clauses), query.model, match, is_summary=False)
+            if not self.contains_negation() and not any(nested for pos, neg, nested in clauses):
+                # only rows related to one of the terms can match
+                alias, column = query.aggregates[match].col
+                pks = sorted(set(pk for pos, neg, nested in clauses for pk in pos))
+                query.where.add((Constraint(alias, column, None), 'in', pks), AND)
+            query.add_q(models.Q(**{match: 1}))
+        elif self.use_subqueries and relation:
+            table, source, target, column = relation
+            query.where.add(ManyRelatedWhere(query.get_initial_alias(), column, (table, source, target), clauses), AND)
         else:
-            for disj in self.conjunction:
-                query.add_q(reduce_or(self.q_for_obj(obj, negated) for obj, negated in disj), set())
+            for clause in self.clauses:
+                query.add_q(reduce_or(self.q_for_term(query, key, negated) for key, negated in self.table.key_literals(clause)), set())
+                
+    def get_relation(self, model):
+        """ 
+        Returns `(table, source column, target column, model column)` for the many-valued relation `self.field` of `model`, 
+        or None if `self.field` is not such a relation.
+        """
+        if self.lookup != 'exact' or LOOKUP_SEP in self.field:
+            return None
+        try:
+            field, _, direct, m2m = model._meta.get_field_by_name(self.field)
+        except FieldDoesNotExist:
+            return None
+        pk_column = model._meta.pk.column
+        if m2m and direct:
+            return field.m2m_db_table(), field.m2m_column_name(), field.m2m_reverse_name(), pk_column
+        elif m2m:
+            field = field.field
+            return field.m2m_db_table(), field.m2m_reverse_name(), field.m2m_column_name(), pk_column
+        elif not direct:
+            field = field.field
+            return field.model._meta.db_table, field.column, field.model._meta.pk.column, field.rel.get_related_field().column
+        return None
+        
+    def _compile_clauses(self, clauses, table):
+        compiled = []
+        for clause in sorted(clauses):
+            pos, neg, nested = [], [], []
+            for key, negated in table.key_literals(clause):
+                if isinstance(key, SubqueryTerm):
+                    nested.append((negated, self._compile_clauses(key.q.clauses, key.q.table)))
+                elif negated:
+                    neg.append(key)
+                else:
+                    pos.append(key)
+            compiled.append((sorted(pos), sorted(neg), nested))
+        return compiled
+            
+    def copy(self):
+        copy = type(self)()
+        copy.table = self.table.copy()
+        copy.clauses = set(self.clauses)
+        copy.trivial = self.trivial
+        return copy
             
-    def clone(self, conj):
+    def clone(self, clauses, table=None):
+        # expressions never share a table, so combining them doesn't change the operands
         clone = type(self)()
-        clone.conjunction = conj
+        clone.table = table or self.table.copy()
+        clone.clauses = clauses
         clone.optimize()
         return clone
         
+    def _import_clauses(self, other, table=None):
+        # Translates the clauses of `other` into bitmasks over `table` (defaults to `self.table`).
+        table = table or self.table
+        if table.keys[:len(other.table.keys)] == other.table.keys:
+            return other.clauses
+        bits = {}
+        def remap(mask):
+            result = 0
+            for bit in iter_bits(mask):
+                if bit not in bits:
+                    bits[bit] = table.bit(other.table.get_term(other.table.keys[bit.bit_length() - 1]))
+                result |= bits[bit]
+            return result
+        return set((remap(pos), remap(neg)) for pos, neg in other.clauses)
+        
+    def is_term(self, obj):
+        return isinstance(obj, self.model) or isinstance(obj, (int, long))
+        
     def contains_negation(self):
-        for disj in self.conjunction:
-            for obj, neg in disj:
-                if neg:
-                    return True
+        for pos, neg in self.clauses:
+            if neg:
+                return True
         return False
         
+    def contains_subqueries(self):
+        return any(isinstance(key, SubqueryTerm) for key in self.table.keys)
+        
+    @property
+    def conjunction(self):
+        return set(frozenset(self.table.literals(clause)) for clause in self.clauses)
+        
     @property
     def objects(self):
-        return set(obj for obj, neg in disj for disj in self.conjunction)
+        mask = 0
+        for pos, neg in self.clauses:
+            mask |= pos | neg
+        objects = set()
+        for obj in self.table.get_objects(mask):
+            if isinstance(obj, SubqueryTerm):
+                objects.update(obj.q.objects)
+            else:
+                objects.add(obj)
+        return objects
 
     @property
     def terms(self):
-        return set(reduce(lambda a, b: a.union(b), self.conjunction))
+        return set(literal for clause in self.clauses for literal in self.table.literals(clause))
     
     def optimize(self):
         if self.trivial is not None:
@@ -84,68 +369,99 @@ class ManyRelatedJoinQ(object):
         # - optimize: (~a | a) & (~a | ~b) <=> (~a | ~b)
         # - negate: ~(~a | ~b) <=> a & b
         # - optimize ..        
-        conj = self.conjunction
+        # The negations are skipped if they would exceed `max_clauses`.
+        conj = self.clauses
         conj = self._optimize(conj)
         if not conj:
             self.trivial = True
         else:
-            conj = self._negate(conj)
-            conj = self._optimize(conj)
-            if not conj:
-                self.trivial = False
-            else:
-                conj = self._negate(conj)
-                conj = self._optimize(conj)
-                if not conj:
-                    self.trivial = True
-        self.conjunction = conj
+            negated = self._expand_negation(conj)
+            if negated is not None:
+                if not negated:
+                    self.trivial = False
+                    conj = negated
+                else:
+                    negated = self._expand_negation(negated)
+                    if negated is not None:
+                        conj = negated
+                        if not conj:
+                            self.trivial = True
+        self.clauses = conj
      
-    def _optimize(self, conjunction):
-        conj = set(conjunction)
-        for disj in conjunction:
-            removed = False
-            # (a | ~a) <=> True
-            for obj, neg in disj:
-                if (obj, not neg) in disj:
-                    conj.remove(disj)
-                    removed = True
+    def _optimize(self, clauses):
+        # (a | ~a) <=> True
+        conj = set((pos, neg) for pos, neg in clauses if not pos & neg)
+        # a => (a | b): drop clauses that are a superset of another clause
+        result = set()
+        for pos, neg in sorted(conj, key=lambda c: bin(c[0]).count('1') + bin(c[1]).count('1')):
+            for p, n in result:
+                if not (p & ~pos or n & ~neg):
                     break
-            if not removed:
-                # a => (a | b)
-                for d in conj:
-                    if d < disj:
-                        conj.remove(disj)
-                        removed = True
-                        break
-        return conj 
+            else:
+                result.add((pos, neg))
+        return result
     
-    def _negate(self, conjunction):
+    def _expand_negation(self, clauses):
         # Applying De Morgan's laws we get disjunctive normal form ..
-        disj = set(frozenset((obj, not neg) for obj, neg in disj) for disj in conjunction)
         # .. a crossproduct will yield conjunctive normal form again.
-        conj = cross_product(*disj)
-        return conj        
+        # Returns the optimized negation, or None if it grows beyond `max_clauses`.
+        conj = set([(0, 0)])
+        for pos, neg in sorted(clauses):
+            conj = set(
+                [(p, n | bit) for p, n in conj for bit in iter_bits(pos) if not p & bit] + 
+                [(p | bit, n) for p, n in conj for bit in iter_bits(neg) if not n & bit]
+            )
+            if len(conj) > self.max_clauses:
+                conj = self._optimize(conj)
+                if len(conj) > self.max_clauses:
+                    return None
+        return self._optimize(conj)
+        
+    def _negate(self, clauses, table):
+        negated = self._expand_negation(clauses)
+        if negated is None:
+            q = type(self)()
+            q.table = self.table.copy()
+            q.clauses = set(clauses)
+            negated = set([(0, table.bit(SubqueryTerm(q)))])
+        return negated
         
     def __and__(self, other):
         if self.trivial is False:
             return self
-        if isinstance(other, self.model):
-            conj = _add(self.conjunction, (other, False), frozenset)
-            return self.clone(conj)
+        if self.is_term(other):
+            table = self.table.copy()
+            conj = self.clauses.union([(table.bit(other), 0)])
+            return self.clone(conj, table)
         elif isinstance(other, type(self)):
-            conj = self.conjunction.union(other.conjunction)
-            return self.clone(conj)
+            if other.trivial is True:
+                return self
+            elif other.trivial is False:
+                return other
+            table = self.table.copy()
+            conj = self.clauses.union(self._import_clauses(other, table))
+            return self.clone(conj, table)
         raise TypeError()
 
     def __or__(self, other):
         if self.trivial is True:
             return self
-        if isinstance(other, self.model):
-            conj = set(_add(disj, (other, False), None) for disj in self.conjunction)
-            return self.clone(conj)
+        elif self.trivial is False:
+            return self.clone(set()) & other
+        if self.is_term(other):
+            table = self.table.copy()
+            bit = table.bit(other)
+            conj = set((pos | bit, neg) for pos, neg in self.clauses)
+            return self.clone(conj, table)
         elif isinstance(other, type(self)):
-            conj = set(disj.union(other_disj) for disj in self.conjunction for other_disj in other.conjunction)
-            return self.clone(conj)
+            if other.trivial is True:
+                return other
+            elif other.trivial is False:
+                return self
+            table = self.table.copy()
+            other_clauses = self._import_clauses(other, table)
+            conj = set((pos | p, neg | n) for pos, neg in self.clauses for p, n in other_clauses)
+            return self.clone(conj, table)
         raise TypeError(type(other))
 
     def __invert__(self):
@@ -154,13 +470,14 @@ class ManyRelatedJoinQ(object):
             clone.trivial = not self.trivial
             return clone
         else:
-            conj = self._negate(self.conjunction)
-            return self.clone(conj)
+            table = self.table.copy()
+            conj = self._negate(self.clauses, table)
+            return self.clone(conj, table)
 
     def __eq__(self, other):
         if self.trivial is not None:
             return self.trivial is other.trivial
-        return self.conjunction == other.conjunction
+        return self.clauses == self._import_clauses(other, self.table.copy())
         
     def __ne__(self, other):
         return not(self == other)
@@ -170,10 +487,12 @@ class ManyRelatedJoinQ(object):
             return True
         elif self.trivial is True:
             return other.trivial is True
-        for disj in self.conjunction:
+        other_clauses = self._import_clauses(other, self.table.copy())
+        for pos, neg in self.clauses:
             implied = False
-            for other_disj in other.conjunction:
-                if disj < other_disj:
+            for p, n in other_clauses:
+                # proper subset
+                if not (pos & ~p or neg & ~n) and (pos, neg) != (p, n):
                     implied = True
                     break
             if not implied:
@@ -184,12 +503,13 @@ class ManyRelatedJoinQ(object):
         return other < self        
 
     def __len__(self):
-        return len(self.conjunction)
+        return len(self.clauses)
 
     def __repr__(self):
-        if not self.conjunction:
+        if not self.clauses:
             return "true"
-        sorted_labels = sorted(sorted((unicode(obj), neg) for obj, neg in disj) for disj in self.conjunction)
+        # unloaded terms are represented by their primary key
+        sorted_labels = sorted(sorted((unicode(self.table.get_term(key)), neg) for key, neg in self.table.key_literals(clause)) for clause in self.clauses)
         return " & ".join([
             "(%s)" % " | ".join([
                 "%s%s" % (neg and "~" or "", label) for label, neg in disj
@@ -199,45 +519,120 @@ class ManyRelatedJoinQ(object):
         
     def get_prefix_notation(self, key='pk', and_op='A', or_op='O', not_op='N', separator='-'):
         conj = []
-        for disj in self.conjunction:
+        for clause in self.clauses:
+            if key == 'pk':
+                disj = self.table.key_literals(clause)
+            else:
+                disj = self.table.literals(clause)
             ops = or_op * (len(disj) - 1)
-            args = separator.join("%s%s" % (neg and not_op or "", getattr(tag, key)) for tag, neg in disj)
+            args = separator.join("%s%s" % (
+                neg and not_op or "", 
+                isinstance(tag, SubqueryTerm) and tag.q.get_prefix_notation(key, and_op, or_op, not_op, separator) or getattr(tag, key, tag),
+            ) for tag, neg in disj)
             conj.append(ops + args)
-        ops = and_op * (len(self.conjunction) - 1)
+        ops = and_op * (len(self.clauses) - 1)
         args = separator.join(conj)
         return ops + args
     
     @classmethod
-    def from_prefix_notation(cls, f, key='pk', and_op='A', or_op='O', not_op='N', separator='-'):
-        kwargs = dict(key=key, and_op=and_op, or_op=or_op, not_op=not_op, separator=separator)
-        if isinstance(f, (str, unicode)):
-            f = StringIO(f)
-        c = f.read(1)
-        if c == and_op or c == or_op:
-            q0 = cls.from_prefix_notation(f, **kwargs)
-            comma = f.read(1)
-            if comma != separator:
-                raise ValueError("'%s' expected" % separator)
-            q1 = cls.from_prefix_notation(f, **kwargs)
-            if c == and_op:
-                return q0 & q1
-            elif c == or_op:
-                return q0 | q1
-        elif c == not_op:
-            return ~cls.from_prefix_notation(f, **kwargs)
+    def from_prefix_notation(cls, f, key='pk', and_op='A', or_op='O', not_op='N', separator='-', cache=True):
+        """
+        Parses an expression created by `get_prefix_notation()`. All referenced objects are fetched with a single query. 
+        Results for strings are kept in an LRU cache unless `cache=False`, each call returns a copy with its own term table.
+        """
+        if not isinstance(f, basestring):
+            f = f.read()
+        cache_key = (cls, f, key, and_op, or_op, not_op, separator)
+        if cache:
+            q = prefix_notation_cache.get(cache_key)
+            if q is not None:
+                return q.copy()
+        tokens = cls._tokenize_prefix_notation(f, and_op, or_op, not_op, separator)
+        keys = set(token for token in tokens if token not in (and_op, or_op, not_op))
+        if key == 'pk':
+            # primary keys are used as terms directly
+            to_python = hasattr(cls.model, '_meta') and cls.model._meta.pk.to_python or int
+            terms = dict((k, to_python(k)) for k in keys)
         else:
-            buf = []
-            while c and c in "0123456789":
-                buf.append(c)            
-                c = f.read(1)
-            f.seek(f.tell() - 1)
-            return get_query_set(cls.model).get(**{key: "".join(buf)}) 
+            terms = cls._resolve_keys(keys, key)
+        
+        # evaluate from right to left, the operands of an operator are on top of the stack
+        table = TermTable(cls.model)
+        stack = []
+        for token in reversed(tokens):
+            if token == not_op:
+                if not stack:
+                    raise ValueError("operand for '%s' expected" % token)
+                stack.append(~stack.pop())
+            elif token == and_op or token == or_op:
+                if len(stack) < 2:
+                    raise ValueError("two operands for '%s' expected" % token)
+                q0, q1 = stack.pop(), stack.pop()
+                if token == and_op:
+                    stack.append(q0 & q1)
+                else:
+                    stack.append(q0 | q1)
+            else:
+                q = cls()
+                q.table = table
+                q.clauses = set([(table.bit(terms[token]), 0)])
+                stack.append(q)
+        if len(stack) != 1:
+            raise ValueError("invalid expression: %r" % f)
+        q = stack[0]
+        if cache:
+            prefix_notation_cache[cache_key] = q
+            return q.copy()
+        return q
+        
+    @classmethod
+    def _tokenize_prefix_notation(cls, f, and_op, or_op, not_op, separator):
+        # Returns operators and keys, separators are checked and dropped: 
+        # each key except the last one ends the first operand of a binary operator and must be followed by a separator.
+        tokens = re.findall(r'[0-9]+|.', f, re.S)
+        result = []
+        # the number of operands still expected
+        expected = 1
+        for i, token in enumerate(tokens):
+            if token == separator:
+                if not i or tokens[i - 1][0] not in '0123456789' or i + 1 == len(tokens):
+                    raise ValueError("unexpected '%s'" % separator)
+                continue
+            if not expected:
+                raise ValueError("unexpected %r" % token)
+            if token[0] in '0123456789':
+                if i + 1 < len(tokens) and tokens[i + 1] != separator:
+                    raise ValueError("'%s' expected" % separator)
+                expected -= 1
+            elif token == and_op or token == or_op:
+                expected += 1
+            elif token != not_op:
+                raise ValueError("unexpected %r" % token)
+            result.append(token)
+        if expected:
+            raise ValueError("incomplete expression: %r" % f)
+        return result
+        
+    @classmethod
+    def _resolve_keys(cls, keys, key='pk'):
+        # Returns a dict that maps each of `keys` to an object of `cls.model`.
+        if not keys:
+            return {}
+        objects = {}
+        for obj in get_query_set(cls.model).filter(**{'%s__in' % key: list(keys)}):
+            objects[str(getattr(obj, key))] = obj
+        missing = keys.difference(objects)
+        if missing:
+            raise cls.model.DoesNotExist("%s matching %s=%s does not exist" % (cls.model._meta.object_name, key, ", ".join(sorted(missing))))
+        return objects
 
     @classmethod
     def all(cls, *objs):
-        return cls().clone(set(frozenset(((obj, False),)) for obj in objs))
+        q = cls()
+        return q.clone(set((q.table.bit(obj), 0) for obj in objs), q.table)
         
     @classmethod
     def any(cls, *objs):
-        return cls().clone(set([frozenset((obj, False) for obj in objs)]))
+        q = cls()
+        return q.clone(set([(q.table.mask(objs), 0)]), q.table)
     
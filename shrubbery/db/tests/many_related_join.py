@@ -94,18 +94,97 @@ class ManyRelatedJoinTest(unittest.TestCase):
 
         self.failIf(Foo.objects.complex_filter(FooTagQ(a) & ~FooTagQ(a)).exists())
         
+        # negations beyond max_clauses become subqueries
+        foo_c = set(Foo.objects.filter(name__contains="C"))
+        foo_d = set(Foo.objects.filter(name__contains="D"))
+        FooTagQ.max_clauses = 2
+        try:
+            q = ~((FooTagQ(a) | b) & (FooTagQ(c) | d))
+            self.failUnlessEqual(len(q), 1)
+            self.failUnlessEqual(q.objects, set([a, b, c, d]))
+            for FooTagQ.use_subqueries in (True, False):
+                self.failUnlessEqual(foo_tag_filter(q), foo_all.difference(foo_a.union(foo_b).intersection(foo_c.union(foo_d))))
+                self.failUnlessEqual(foo_tag_filter(~q), foo_a.union(foo_b).intersection(foo_c.union(foo_d)))
+        finally:
+            del FooTagQ.max_clauses, FooTagQ.use_subqueries
+            
+        q = (FooTagQ(a) | ~FooTagQ(b)) & ~FooTagQ(c) & (~FooTagQ(c) | ~FooTagQ(d))
+        expected = set(foo for foo in foo_all if ('A' in foo.name or 'B' not in foo.name) and 'C' not in foo.name)
+        # a single grouped scan, clauses are tested in HAVING
+        qs = Foo.objects.complex_filter(q)
+        self.failUnlessEqual(str(qs.query).count('JOIN'), 1)
+        self.failUnlessEqual(set(qs), expected)
+        self.failUnlessEqual(set(Foo.objects.complex_filter(FooTagQ(b) & (FooTagQ(a) | c))), foo_b.intersection(foo_a.union(foo_c)))
+        # chained filters are combined, only the first one uses the grouped scan
+        qs = Foo.objects.complex_filter(FooTagQ(a) & b).complex_filter(FooTagQ(c) & ~FooTagQ(d))
+        self.failUnlessEqual(set(qs), foo_a.intersection(foo_b).intersection(foo_c).difference(foo_d))
+        # the grouped scan can't share a join of the relation with other filters
+        qs = Foo.objects.filter(tags=a).complex_filter(FooTagQ(b) & FooTagQ(c))
+        self.failUnlessEqual(set(qs), foo_a.intersection(foo_b).intersection(foo_c))
+        qs = Foo.objects.filter(tags=a).complex_filter(FooTagQ(b) & ~FooTagQ(c))
+        self.failUnlessEqual(set(qs), foo_a.intersection(foo_b).difference(foo_c))
+        qs = Foo.objects.filter(tags=b).complex_filter((FooTagQ(a) | c) & b)
+        self.failUnlessEqual(set(qs), foo_b.intersection(foo_a.union(foo_c)))
+        qs = Foo.objects.annotate(mrj_match=models.Max('name')).complex_filter(FooTagQ(a) & c)
+        self.failUnlessEqual(set(qs), foo_a.intersection(foo_c))
+        self.failUnlessEqual(set(foo.mrj_match for foo in qs), set(foo.name for foo in qs))
+        # clauses are compiled to correlated subqueries, without joins
+        FooTagQ.use_aggregation = False
+        try:
+            qs = Foo.objects.complex_filter(q)
+            self.failIf('JOIN' in str(qs.query))
+            self.failUnlessEqual(set(qs), expected)
+            self.failUnlessEqual(set(Foo.objects.filter(pk__in=qs)), expected)
+        finally:
+            del FooTagQ.use_aggregation
+        bar = Bar.objects.create(name="bar")
+        bar_tags = [BarTag.objects.create(name=name, bar=bar) for name in "AB"]
+        self.failUnlessEqual(list(Bar.objects.complex_filter(BarTagQ(bar_tags[0]) & ~BarTagQ(bar_tags[1]))), [])
+        self.failUnlessEqual(list(Bar.objects.complex_filter(BarTagQ(bar_tags[0]) | ~BarTagQ(bar_tags[1]))), [bar])
+        
         self.failUnlessEqual(repr(~(a | b & c)), "(~A) & (~B | ~C)")
         self.failUnlessEqual(repr((a & b) | (c & d)), "(A | C) & (A | D) & (B | C) & (B | D)")
         self.failUnlessEqual(repr((~a & b) | (a & ~b)), "(A | B) & (~A | ~B)")
         self.failUnlessEqual(repr(~~(a & b & c)), "(A) & (B) & (C)")
         self.failUnlessEqual(repr(~a | a), "true")
         self.failUnlessEqual(repr(a & (~a | b)), "(A) & (B)")
+        self.failUnlessEqual(repr(c | (a & ~a)), "(C)")
+        self.failUnlessEqual(repr(c & (a | ~a)), "(C)")
+        self.failUnlessEqual(repr((a & ~a) | c), "(C)")
+        self.failUnlessEqual(FooTagQ(a) & FooTagQ(b), FooTagQ(b) & FooTagQ(a))
+        # combined expressions get their own term table
+        q = FooTagQ(a)
+        for r in (q & b, q | c, ~(q | d)):
+            self.failIf(r.table is q.table)
+        self.failUnlessEqual(q.table.keys, [a.pk])
+        self.failUnlessEqual(repr(q), "(A)")
+        self.failUnless(FooTagQ(a) < FooTagQ(a) | FooTagQ(b))
         #print repr((a & ((~a|c) & (~c | b))))
         #print repr((a|b) & (~a | ~b))
         #print repr((a|b) & (c | (~a & ~b)))
         #print a | b | c < a | b
         #print a | b < a | b | c        
 
+        for q in (a & b, (a | ~b) & ~c, ~((a | b) & (c | d)), FooTagQ(d)):
+            notation = q.get_prefix_notation()
+            self.failUnlessEqual(FooTagQ.from_prefix_notation(notation), q)
+            cached = FooTagQ.from_prefix_notation(notation)
+            self.failIf(cached is FooTagQ.from_prefix_notation(notation))
+            self.failIf(cached.table is FooTagQ.from_prefix_notation(notation).table)
+            self.failUnlessEqual(FooTagQ.from_prefix_notation(notation, cache=False), q)
+        self.failUnlessEqual(FooTagQ.from_prefix_notation("AN%s-O%s-%s" % (a.pk, b.pk, c.pk)), ~a & (b | c))
+        for invalid in ("A%s" % a.pk, "A%s%s" % (a.pk, b.pk), "%s-" % a.pk, "N", "X1"):
+            self.failUnlessRaises(ValueError, FooTagQ.from_prefix_notation, invalid)
+        self.failUnlessEqual(foo_tag_filter(FooTagQ.from_prefix_notation("O%s-0" % a.pk)), foo_a)
+        
+        # terms may be primary keys, objects are loaded when needed
+        q = (FooTagQ(a.pk) | b.pk) & ~FooTagQ(c.pk)
+        self.failUnlessEqual(repr(q), "(%s | %s) & (~%s)" % (a.pk, b.pk, c.pk))
+        self.failUnlessEqual(q.get_prefix_notation(), ((FooTagQ(a) | b) & ~FooTagQ(c)).get_prefix_notation())
+        self.failUnlessEqual(foo_tag_filter(q), foo_a.union(foo_b).difference(foo_c))
+        self.failUnlessEqual(q, (FooTagQ(a) | b) & ~FooTagQ(c))
+        self.failUnlessEqual(q.objects, set([a, b, c]))
+        self.failUnlessEqual(repr(q), "(A | B) & (~C)")
         #print (a & b & c & d).get_prefix_notation()
         #print ((~a & b) | (a & ~b)).get_prefix_notation()
 
@@ -1,12 +1,15 @@
+import datetime
 from unittest import TestCase
 
 from django.db import models, connection
 from django.conf import settings
 
-from shrubbery.db.union import UnionQuerySet
+from shrubbery.db import union
+from shrubbery.db.union import UnionQuerySet, parallel_fetch
 
 class UABC(models.Model):
     abc = models.CharField(max_length=42)
+    created = models.DateField(null=True)
     
     def __unicode__(self):
         return self.abc
@@ -43,7 +46,9 @@ class UnionTest(TestCase):
         ub = UB.objects.create(abc="abc2", a="a2", b="b2")
         uc = UC.objects.create(abc="abc3", a="a3", b="b3", c="c3")
         settings.DEBUG = True
-        u = UnionQuerySet(UABC)
+        # the order of the sub models of an abstract model is undefined
+        self.failUnlessEqual(set(UnionQuerySet(UABC)), set([ua, ub, uc]))
+        u = UnionQuerySet(UA, UB, UC)
 
         #self.failUnlessEqual([obj.pk for obj in u.fetch_objects()], [ua.pk, ub.pk, uc.pk])
         self.failUnlessEqual(list(u), [ua, ub, uc])
@@ -56,16 +61,153 @@ class UnionTest(TestCase):
         self.failUnlessEqual(u[2], uc)
         self.assertRaises(IndexError, u.__getitem__, 3)
 
+        self.failUnlessEqual(u.get_counts(), [1, 1, 1])
+        self.failUnlessEqual(u.count(), 3)
+        ua_u = UnionQuerySet(UA)
+        self.failUnlessEqual(ua_u.count(), 1)
+        self.failUnlessEqual((ua_u | UB.objects.all()).count(), 2)
+        self.failUnlessEqual(list((ua_u | UnionQuerySet(UB, UC))[1:]), [ub, uc])
+        self.failUnlessEqual((ua_u | UnionQuerySet(UB, UC))[2], uc)
+        self.failUnlessEqual(len(u[1:]), 2)
+        self.failUnlessEqual(u[1:][0], ub)
+        self.failUnlessEqual(u.filter(a='a2').count(), 1)
+        self.failUnlessEqual(u.none().count(), 0)
+        self.failUnlessEqual(list(u[2:5]), [uc])
+
+        self.failUnlessEqual(list(u.iterator()), [ua, ub, uc])
+        self.failUnlessEqual(list(u[1:].iterator()), [ub, uc])
+        self.failUnlessEqual(list(u[1:2].iterator()), [ub])
+        self.failUnlessEqual(list(UnionQuerySet(UA, UB, UC)[2:].iterator()), [uc])
+        self.failUnlessEqual(list(u.order_and_sort_by('-abc').iterator()), [uc, ub, ua])
+
         self.failUnlessEqual(list(u.values('a')), [{'a': u'a1'}, {'a': u'a2'}, {'a': u'a3'}])
         self.failUnlessEqual(list(u.coerce(UA)), [ua])
         
         print u.sort('pk')
         print u.sort('pk')[:2]
         print u.sort('-pk')
+
+        self.failUnlessEqual(list(u.order_and_sort_by('abc')), [ua, ub, uc])
+        self.failUnlessEqual(list(u.order_and_sort_by('-abc')), [uc, ub, ua])
+        self.failUnlessEqual(list(u.order_and_sort_by('-abc')[1:]), [ub, ua])
+        self.failUnlessEqual(list(u.order_by('abc').sort('abc', chunk_size=1)), [ua, ub, uc])
+        # equal keys are yielded in queryset order
+        self.failUnlessEqual(list(u.sort(lambda obj: 0)), [ua, ub, uc])
+        self.failUnlessEqual(list(u.sort(lambda obj: 0, reverse=True)), [ua, ub, uc])
+
+        self.failUnlessEqual(list(u.order_and_sort_by('abc').seek('abc1')), [ub, uc])
+        self.failUnlessEqual(list(u.order_and_sort_by('-abc').seek('abc3')[:1]), [ub])
+        self.failUnlessEqual(list(u.order_and_sort_by('abc').seek('abc3')), [])
+        self.assertRaises(TypeError, u.seek, 'abc1')
+
+        self.failUnlessEqual([obj.abc for obj in u.sql_union()], ['abc1', 'abc2', 'abc3'])
+        self.failUnlessEqual([obj.abc for obj in u.sort('-abc').sql_union()], ['abc3', 'abc2', 'abc1'])
+        self.failUnlessEqual([obj.abc for obj in u.sort('-abc').sql_union()[1:]], ['abc2', 'abc1'])
+        self.failUnless(isinstance(list(u.sort('abc').sql_union())[1], UB))
+        self.failUnlessEqual(list(u.filter(a='a2').fetch_values(['abc'])), [{'abc': u'abc2'}])
+        self.failUnlessEqual(list(u.none().fetch_values()), [])
+        self.failUnlessEqual(list(u.fetch_values_list(['abc', 'a'])), [(u'abc1', u'a1'), (u'abc2', u'a2'), (u'abc3', u'a3')])
+        self.failUnlessEqual(list(u.sort('-abc').fetch_values_list(['a'], flat=True)), [u'a3', u'a2', u'a1'])
+        filtered = u.filter(a='a1')
+        prepared = filtered.prepare(['abc'])
+        self.failUnless(filtered.prepare(('abc',)) is prepared)
+        self.failUnlessEqual(list(prepared.fetch_values_list(flat=True)), [u'abc1'])
+        params = tuple(param == 'a1' and 'a2' or param for param in prepared.params)
+        self.failUnlessEqual(list(prepared.fetch_values_list(params, flat=True)), [u'abc2'])
+        self.failUnlessEqual(u.get_common_fields(), ('id', 'abc', 'created', 'a'))
+        # unfiltered unions share their prepared statements
+        prepared = UnionQuerySet(UA, UB).sort('abc').prepare()
+        self.failUnless(UnionQuerySet(UA, UB).sort('abc').prepare() is prepared)
+        self.failIf(UnionQuerySet(UA, UB).sort('-abc').prepare() is prepared)
+        self.failIf(UnionQuerySet(UA, UB).sort('abc')[:1].prepare() is prepared)
+        self.failIf(UnionQuerySet(UA, UB).sort('abc').filter(a='a1').prepare() is prepared)
+        self.failUnlessEqual([obj.abc for obj in UnionQuerySet(UA, UB).sort('abc').fetch_objects()], ['abc1', 'abc2'])
+
+        self.failUnlessEqual(u.aggregate(models.Count('pk'), max_abc=models.Max('abc')), {'pk__count': 3, 'max_abc': u'abc3'})
+        self.failUnlessEqual(u.filter(a='a2').aggregate(min_abc=models.Min('abc')), {'min_abc': u'abc2'})
+        self.failUnlessEqual(u.none().aggregate(n=models.Count('pk'), m=models.Max('abc')), {'n': 0, 'm': None})
+        self.failUnlessEqual(UnionQuerySet().aggregate(n=models.Count('pk')), {'n': 0})
+        self.failUnlessEqual(UnionQuerySet().aggregate(n=models.Count('pk'), m=models.Max('abc')), {'n': 0, 'm': None})
+        UB.objects.filter(pk=ub.pk).update(created=datetime.date(2011, 2, 3))
+        self.failUnlessEqual(u.aggregate(d=models.Max('created'), n=models.Sum('pk')), {'d': datetime.date(2011, 2, 3), 'n': ua.pk + ub.pk + uc.pk})
+        self.failUnlessEqual(u._combine_aggregates({'n': models.Count('pk'), 'm': models.Min('abc')}), {'n': 3, 'm': u'abc1'})
+        self.failUnlessEqual(u.sort(lambda obj: obj.a).aggregate(n=models.Count('pk')), {'n': 3})
+        for sliced in (u[1:], u[:2], u.order_and_sort_by('-abc')[1:], u.sort(lambda obj: obj.a, reverse=True)[:2]):
+            aggregates = {'n': models.Count('pk'), 'm': models.Min('abc'), 'x': models.Max('abc')}
+            expected = {'n': len(list(sliced)), 'm': min(obj.abc for obj in sliced), 'x': max(obj.abc for obj in sliced)}
+            self.failUnlessEqual(sliced._combine_aggregates(aggregates), expected)
+            self.failUnlessEqual(sliced.aggregate(**aggregates), expected)
+        # (id, a) is not a prefix of the models' fields
+        self.failUnlessEqual([(obj.a, obj.abc) for obj in u.fetch_objects(['a', 'id'])], [(u'a1', u'abc1'), (u'a2', u'abc2'), (u'a3', u'abc3')])
         
         u = UnionQuerySet(UA, UB, UA.objects.filter(a__contains="a"))
         print u
         
         
         
-        
\ No newline at end of file
+        
+
+    def test_seek_ties(self):
+        objects = [UA.objects.create(abc="t1", a="a"), UA.objects.create(abc="t2", a="a"), UB.objects.create(abc="t2", a="a", b="b"), UB.objects.create(abc="t2", a="a", b="b"), UC.objects.create(abc="t3", a="a", b="b", c="c")]
+        u = UnionQuerySet(UA, UB, UC).filter(abc__startswith='t')
+        for attr in ('abc', '-abc'):
+            ordered = u.order_and_sort_by(attr)
+            expected = list(ordered)
+            self.failUnlessEqual(set(expected), set(objects))
+            self.failUnlessEqual(len(expected), len(objects))
+            pages = [list(ordered[:2])]
+            while pages[-1]:
+                last = pages[-1][-1]
+                pages.append(list(ordered.seek(last.abc, last=last)[:2]))
+            self.failUnlessEqual(sum(pages, []), expected)
+        self.assertRaises(ValueError, u.order_and_sort_by('abc').seek, 't1', objects[0].pk)
+        for obj in objects:
+            obj.delete()
+
+    def test_parallel(self):
+        # in-memory sqlite databases cannot be shared with other threads, so workers run serially in the test
+        started = []
+        def start_worker(work):
+            started.append(work)
+            work()
+        ua = UA.objects.create(abc="p1", a="a")
+        ub = UB.objects.create(abc="p2", a="a", b="b")
+        uc = UC.objects.create(abc="p0", a="a", b="b", c="c")
+        results = parallel_fetch([UA.objects.filter(abc__startswith='p'), UB.objects.filter(abc__startswith='p')], 4, start_worker=start_worker)
+        self.failUnlessEqual(len(started), 2)
+        self.failUnlessEqual([list(result) for result in results], [[ua], [ub]])
+        
+        failing = parallel_fetch([UA.objects.extra(where=['no_such_column = 1'])], 1, start_worker=start_worker)[0]
+        self.assertRaises(Exception, list, failing)
+        
+        start_worker_thread = union.start_worker_thread
+        union.start_worker_thread = start_worker
+        try:
+            u = UnionQuerySet(UA, UB, UC).filter(abc__startswith='p').parallel(2)
+            self.failUnlessEqual(list(u), [ua, ub, uc])
+            self.failUnlessEqual(list(u.order_and_sort_by('abc')), [uc, ua, ub])
+            self.failUnlessEqual(list(u.order_and_sort_by('-abc')[:2]), [ub, ua])
+            self.failUnlessEqual(list(u[1:]), [ub, uc])
+        finally:
+            union.start_worker_thread = start_worker_thread
+        for obj in (ua, ub, uc):
+            obj.delete()
+
+    def test_iter_chunked(self):
+        objs = [UA.objects.create(abc="chunk%s" % (i // 2), a=str(i)) for i in range(5)]
+        qs = UA.objects.filter(abc__startswith='chunk')
+        for ordering in (('abc',), ('-abc',), ('-abc', 'a'), ('-pk',)):
+            ordered = qs.order_by(*ordering)
+            expected = list(ordered.order_by(*(ordering + ('pk',))))
+            self.failUnlessEqual(list(union.iter_chunked(ordered, 2)), expected)
+            self.failUnlessEqual(list(union.iter_chunked(ordered[1:4], 2)), expected[1:4])
+        self.failUnlessEqual(union.get_keyset(qs.order_by('?')), None)
+        # values are paged by offset
+        self.failUnlessEqual(list(union.iter_chunked(qs.order_by('pk').values_list('a', flat=True), 2)), [obj.a for obj in objs])
+        
+        # chunks follow the last object of the previous chunk, deleted rows don't shift them
+        it = union.iter_chunked(qs.order_by('pk'), 2)
+        first = [it.next(), it.next()]
+        UA.objects.filter(pk=objs[0].pk).delete()
+        self.failUnlessEqual(first + list(it), objs)
+        qs.delete()
@@ -1,53 +1,413 @@
-import bisect
+import sys
+import heapq
+import operator
 import itertools
-from django.db import connections
-from django.db.models.query import QuerySet
+import threading
+from Queue import Queue, Empty
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet, EmptyQuerySet, ValuesQuerySet
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query_utils import deferred_class_factory
-from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
-from django.db.models.base import ModelBase, Model
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE, LOOKUP_SEP
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.base import ModelBase, Model, ModelState
+from django.db.models import signals, Sum, Count, Q
 from django.db.models.loading import cache as app_cache
 
 from shrubbery.db.utils import get_query_set, get_sub_models
-from shrubbery.utils import reduce_and
+from shrubbery.utils import reduce_and, LRUCache
 
 MODEL_COL = '__model'
 
-def sorted_union_generator(querysets, key=None, reverse=False):
-    sorted_seqs = []
-    def _next(it):
+_common_fields_cache = {}
+
+# PreparedUnions of unfiltered unions, keyed by models, database, fields, limits, and sort order
+prepared_union_cache = LRUCache(256)
+
+def _is_unfiltered(qs):
+    # the SQL of an unfiltered queryset only depends on its model, ordering is dropped by UnionQuerySet.as_sql()
+    query = qs.query
+    return not (isinstance(qs, EmptyQuerySet) or query.where.children or query.having.children or query.extra or query.extra_tables 
+        or query.distinct or query.low_mark or query.high_mark is not None)
+
+SQL_AGGREGATES = {
+    'Sum': 'SUM',
+    'Count': 'COUNT',
+    'Min': 'MIN',
+    'Max': 'MAX',
+    'Avg': 'AVG',
+}
+
+def _empty_aggregates(aggregates):
+    result = {}
+    for alias, aggregate in aggregates.items():
+        result[alias] = None
+        if aggregate.name == 'Count':
+            result[alias] = 0
+    return result
+
+def _convert_aggregate(connection, aggregate, value, field):
+    # like Query.resolve_aggregate(), but only values of the field types the backends convert are passed to convert_values()
+    if value is None:
+        return value
+    if aggregate.name == 'Count':
+        return int(value)
+    if aggregate.name == 'Avg':
+        return float(value)
+    internal_type = field.get_internal_type()
+    if internal_type in ('DecimalField', 'DateField', 'DateTimeField', 'TimeField', 'AutoField') or internal_type.endswith('IntegerField'):
+        return connection.ops.convert_values(value, field)
+    return value
+
+def _combine_partial_aggregates(name, values):
+    values = [value for value in values if value is not None]
+    if name == 'Count':
+        return sum(values)
+    if not values:
+        return None
+    if name == 'Sum':
+        return sum(values)
+    if name == 'Min':
+        return min(values)
+    if name == 'Max':
+        return max(values)
+    raise TypeError("cannot combine %s aggregates" % name)
+
+class _Descending(object):
+    """Wraps a sort key and inverts its ordering, so that a min-heap yields the largest key first."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def get_keyset(qs):
+    """ 
+    Returns the ordering of `qs` followed by its pk as a list of `(lookup, attname, descending)` tuples, 
+    or None if `qs` cannot be paged by key: if it's ordered randomly, by extra selects, by related or nullable fields, or returns values.
+    """
+    query = qs.query
+    if isinstance(qs, ValuesQuerySet) or query.extra_order_by:
+        return None
+    opts = qs.model._meta
+    ordering = query.order_by or (query.default_ordering and opts.ordering) or ()
+    keyset = []
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == '?' or LOOKUP_SEP in name:
+            return None
         try:
-            next = it.next()
-            bisect.insort(sorted_seqs, (key(next), next, it))
-        except StopIteration:
-            pass
-    for qs in querysets:
-        _next(iter(qs))
-    while sorted_seqs:
-        if reverse:
-            _, next, it = sorted_seqs.pop()
+            field = name == 'pk' and opts.pk or opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.primary_key:
+            keyset.append(('pk', field.attname, descending))
+            return keyset
+        if field.null or field.rel:
+            return None
+        keyset.append((name, field.attname, descending))
+    keyset.append(('pk', opts.pk.attname, False))
+    return keyset
+
+def seek_after(qs, keyset, obj):
+    """ Filters `qs` (ordered by `keyset`, see `get_keyset()`) to the objects that come after `obj`. """
+    q = None
+    equal = {}
+    for lookup, attname, descending in keyset:
+        value = getattr(obj, attname)
+        after = dict(equal)
+        after["%s__%s" % (lookup, descending and 'lt' or 'gt')] = value
+        if q is None:
+            q = Q(**after)
         else:
-            _, next, it = sorted_seqs[0]
-            del sorted_seqs[0]
-        yield next
-        _next(it)
+            q |= Q(**after)
+        equal[lookup] = value
+    return qs.filter(q)
+
+def iter_chunked(qs, chunk_size=None):
+    """
+    Iterates over `qs`, fetching at most `chunk_size` rows per query. Without a `chunk_size`, `qs` is iterated as is.
+    Chunks after the first one are selected by the ordering values of the previous chunk's last object (keyset pagination), 
+    so every chunk costs the same and no rows are skipped or repeated if rows are inserted or deleted meanwhile. 
+    Querysets that cannot be paged by key (see `get_keyset()`) are paged by offset.
+    """
+    if not chunk_size or not isinstance(qs, QuerySet):
+        for obj in qs:
+            yield obj
+        return
+    keyset = get_keyset(qs)
+    if keyset is None:
+        offset = 0
+        while True:
+            chunk = list(qs[offset:offset + chunk_size])
+            for obj in chunk:
+                yield obj
+            if len(chunk) < chunk_size:
+                break
+            offset += chunk_size
+        return
+    start, stop = qs.query.low_mark, qs.query.high_mark
+    base = qs._clone()
+    base.query.clear_limits()
+    base = base.order_by(*["%s%s" % (descending and '-' or '', lookup) for lookup, attname, descending in keyset])
+    remaining = stop is not None and stop - start or None
+    chunk_qs = base[start:start + chunk_size]
+    while True:
+        size = chunk_size
+        if remaining is not None:
+            size = min(size, remaining)
+            if size <= 0:
+                break
+        chunk = list(chunk_qs[:size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < size:
+            break
+        if remaining is not None:
+            remaining -= size
+        chunk_qs = seek_after(base, keyset, chunk[-1])
+
+
+def sorted_union_generator(querysets, key=None, reverse=False, chunk_size=None):
+    """
+    Merges the already sorted `querysets` into a single sorted sequence (k-way merge). 
+    Objects with equal keys are yielded in the order of their querysets.
+    """
+    if key is None:
+        key = lambda obj: obj
+    if reverse:
+        _key = key
+        key = lambda obj: _Descending(_key(obj))
+    # heap items are (key, index, obj, it) tuples. `index` is unique within the heap, so 
+    # equal keys never cause objects to be compared.
+    heap = []
+    for index, qs in enumerate(querysets):
+        it = iter_chunked(qs, chunk_size)
+        for obj in it:
+            heap.append((key(obj), index, obj, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, index, obj, it = heap[0]
+        yield obj
+        for obj in it:
+            heapq.heapreplace(heap, (key(obj), index, obj, it))
+            break
+        else:
+            heapq.heappop(heap)
         
-def chained_union_generator(querysets, start=None, stop=None, step=None):
+def slice_querysets(querysets, counts, start=None, stop=None):
+    """ Returns the (sliced) querysets that make up `union[start:stop]`, given the number of rows in each queryset. """
+    sliced = []
     offset = 0
+    for qs, count in itertools.izip(querysets, counts):
+        if stop is not None and offset >= stop:
+            break
+        qs_start = max((start or 0) - offset, 0)
+        qs_stop = count
+        if stop is not None:
+            qs_stop = min(stop - offset, count)
+        if qs_start < qs_stop:
+            if qs_start or qs_stop < count:
+                qs = qs[qs_start:qs_stop]
+            sliced.append(qs)
+        offset += count
+    return sliced
+
+def chained_union_generator(querysets, start=None, stop=None, step=None, counts=None):
+    if start or stop is not None:
+        if counts is None:
+            counts = [qs.count() for qs in querysets]
+        querysets = slice_querysets(querysets, counts, start, stop)
     for qs in querysets:
-        qs_start, qs_stop = None, None
-        if start:
-            qs_start = max(start - offset, 0)
-        if stop:
-            qs_stop = stop - offset
-            if qs_stop <= 0 or (qs_start and qs_start >= qs_stop):
-                break
-        if qs_start or qs_stop:
-            qs = qs[qs_start:qs_stop]
         for obj in qs:
             yield obj
-        offset += len(qs)
-        if qs_start:
-            offset += qs_start
+
+def streaming_union_generator(querysets, start=None, stop=None):
+    """ 
+    Like chained_union_generator(), but iterates with `QuerySet.iterator()` and advances the offset by the rows 
+    actually yielded, so no results are cached and no queryset is evaluated twice. 
+    """
+    offset = 0
+    for qs in querysets:
+        if stop is not None and offset >= stop:
+            break
+        qs_start = max((start or 0) - offset, 0)
+        qs_stop = None
+        if stop is not None:
+            qs_stop = stop - offset
+        sliced = qs
+        if qs_start or qs_stop is not None:
+            sliced = qs[qs_start:qs_stop]
+        n = 0
+        for obj in sliced.iterator():
+            n += 1
+            yield obj
+        if n:
+            offset += qs_start + n
+        elif qs_start:
+            # all rows of `qs` were skipped, only a count can tell how many there were
+            offset += qs.count()
+
+
+def get_row_loader(model, fields, db, offset=0):
+    """
+    Returns a function that builds a `model` instance from a row tuple holding the values of `fields` (starting at `offset`).
+    If the loaded fields are a prefix of the model's fields, which is the common case for fields inherited from an 
+    abstract base, rows are passed to the (deferred) model's constructor positionally. Otherwise the instance is 
+    populated directly and only `post_init` is sent.
+    """
+    opts = model._meta
+    positions = dict((opts.get_field(name).attname, offset + i) for i, name in enumerate(fields))
+    loaded = [field.attname for field in opts.fields if field.attname in positions]
+    skip = set(field.attname for field in opts.fields if field.attname not in positions)
+    cls = skip and deferred_class_factory(model, skip) or model
+    if [field.attname for field in opts.fields[:len(loaded)]] == loaded:
+        indexes = [positions[attname] for attname in loaded]
+        if len(indexes) == 1:
+            index = indexes[0]
+            getter = lambda row: (row[index],)
+        else:
+            getter = operator.itemgetter(*indexes)
+        def load(row):
+            obj = cls(*getter(row))
+            obj._state.db = db
+            obj._state.adding = False
+            return obj
+    else:
+        items = positions.items()
+        def load(row):
+            obj = cls.__new__(cls)
+            obj.__dict__.update((attname, row[index]) for attname, index in items)
+            obj._state = ModelState(db)
+            obj._state.adding = False
+            signals.post_init.send(sender=cls, instance=obj)
+            return obj
+    return load
+
+
+class PreparedUnion(object):
+    """
+    The compiled `UNION ALL` statement of a UnionQuerySet together with row loaders for its models.
+    Executing it again skips SQL compilation, `params` may be rebound for each execution. 
+    They must have the same structure as `self.params`.
+    """
+    def __init__(self, union, fields):
+        self.fields = tuple(fields)
+        self.models = union.models
+        self.db = union.db
+        try:
+            self.sql, self.params = union.as_sql(self.fields)
+        except EmptyResultSet:
+            self.sql, self.params = None, ()
+        self._loaders = None
+        
+    def execute(self, params=None):
+        """ Yields result rows: `(model_index,) + field values`. """
+        if self.sql is None:
+            return
+        if params is None:
+            params = self.params
+        connection = connections[self.db]
+        cursor = connection.cursor()
+        cursor.execute(self.sql, params)
+        result = iter((lambda: cursor.fetchmany(GET_ITERATOR_CHUNK_SIZE)), connection.features.empty_fetchmany_value)
+        for chunk in result:
+            for row in chunk:
+                yield row
+                
+    def fetch_values(self, params=None):
+        fields = self.fields
+        for row in self.execute(params):
+            yield dict(zip(fields, row[1:]))
+            
+    def fetch_values_list(self, params=None, flat=False):
+        if flat:
+            if len(self.fields) != 1:
+                raise TypeError("'flat' is only valid when a single field is passed")
+            for row in self.execute(params):
+                yield row[1]
+        else:
+            end = len(self.fields) + 1
+            for row in self.execute(params):
+                yield row[1:end]
+                
+    def fetch_objects(self, params=None):
+        if self._loaders is None:
+            self._loaders = [get_row_loader(model, self.fields, self.db, offset=1) for model in self.models]
+        loaders = self._loaders
+        for row in self.execute(params):
+            yield loaders[row[0]](row)
+
+
+class _ParallelResult(object):
+    """ The result of a queryset that is evaluated by a worker thread. Iteration blocks until the worker is done. """
+    def __init__(self, qs):
+        self.qs = qs
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def fetch(self):
+        try:
+            try:
+                self.result = list(self.qs)
+            except:
+                self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def __iter__(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return iter(self.result)
+
+
+def start_worker_thread(work):
+    """ Runs `work` on a daemon thread that finally closes its own database connections. """
+    def run():
+        try:
+            work()
+        finally:
+            for connection in connections.all():
+                connection.close()
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+
+
+def parallel_fetch(querysets, max_workers, start_worker=None):
+    """ 
+    Evaluates `querysets` on up to `max_workers` workers and returns their results in the same order. 
+    Workers are started with `start_worker(work)`, which defaults to `start_worker_thread()`.
+    """
+    start_worker = start_worker or start_worker_thread
+    results = [_ParallelResult(qs) for qs in querysets]
+    queue = Queue()
+    for result in results:
+        queue.put(result)
+    def work():
+        while True:
+            try:
+                result = queue.get_nowait()
+            except Empty:
+                break
+            result.fetch()
+    for i in xrange(min(max_workers, len(results))):
+        start_worker(work)
+    return results
+
 
 class UnionQuerySet(object):
     def __init__(self, *querysets):
@@ -57,7 +417,13 @@ class UnionQuerySet(object):
             self._add_qs(qs)
         self.limits = (None, None)
         self.sort_key = None
+        self.sort_attr = None
         self.sort_reverse = False
+        self.chunk_size = None
+        self.use_sql_union = False
+        self.max_workers = None
+        self._counts = None
+        self._prepared = {}
         
     def _add_qs(self, qs):
         if isinstance(qs, ModelBase) and qs._meta.abstract:
@@ -73,6 +439,8 @@ class UnionQuerySet(object):
             else:
                 self.querysets.append(qs)
             self.querysets_by_model[qs.model] = qs
+            # cached counts don't cover the changed querysets
+            self._counts = None
     
     def _clone(self, querysets=None):
         copy_querysets = querysets is None
@@ -82,25 +450,60 @@ class UnionQuerySet(object):
         if copy_querysets:
             clone.querysets = self.querysets[:]
             clone.querysets_by_model = self.querysets_by_model.copy()
+            clone._counts = self._counts
         clone.limits = self.limits
         clone.sort_key = self.sort_key
+        clone.sort_attr = self.sort_attr
         clone.sort_reverse = self.sort_reverse
+        clone.chunk_size = self.chunk_size
+        clone.use_sql_union = self.use_sql_union
+        clone.max_workers = self.max_workers
         return clone
+
+    def _get_querysets(self):
+        """ Returns the querysets (or their results, if evaluated in parallel) that have to be iterated for this union. """
+        start, stop = self.limits
+        querysets = self.querysets
+        if self.sort_key:
+            if stop:
+                querysets = [qs[:stop] for qs in querysets]
+        elif start or stop is not None:
+            querysets = slice_querysets(querysets, self.get_counts(), start, stop)
+        if self.max_workers:
+            querysets = parallel_fetch(querysets, self.max_workers)
+        return querysets
     
     def __iter__(self):
+        if self.use_sql_union:
+            return self.fetch_objects()
+        querysets = self._get_querysets()
         if not self.sort_key:
-            return chained_union_generator(self.querysets, *self.limits)
-        else:
-            start, stop = self.limits
-            if stop:
-                querysets = [qs[:stop] for qs in self.querysets]
-            else:
-                querysets = self.querysets
-            sorted_it = sorted_union_generator(querysets, key=self.sort_key, reverse=self.sort_reverse)
-            return itertools.islice(sorted_it, *self.limits)
+            return chained_union_generator(querysets)
+        sorted_it = sorted_union_generator(querysets, key=self.sort_key, reverse=self.sort_reverse, chunk_size=self.chunk_size)
+        return itertools.islice(sorted_it, *self.limits)
             
-    def sort(self, key=None, reverse=False):
+    def iterator(self):
+        """ 
+        Streams the results without caching them, see `QuerySet.iterator()`. Sorted unions are merged from chunks of 
+        `chunk_size` (or GET_ITERATOR_CHUNK_SIZE) rows per queryset. `parallel()` is ignored.
+        """
+        if self.use_sql_union:
+            return self.fetch_objects()
+        start, stop = self.limits
+        if not self.sort_key:
+            if self._counts is not None:
+                querysets = slice_querysets(self.querysets, self._counts, start, stop)
+                return streaming_union_generator(querysets)
+            return streaming_union_generator(self.querysets, start, stop)
+        querysets = self.querysets
+        if stop:
+            querysets = [qs[:stop] for qs in querysets]
+        sorted_it = sorted_union_generator(querysets, key=self.sort_key, reverse=self.sort_reverse, chunk_size=self.chunk_size or GET_ITERATOR_CHUNK_SIZE)
+        return itertools.islice(sorted_it, *self.limits)
+        
+    def sort(self, key=None, reverse=False, chunk_size=None):
         clone = self._clone()
+        attr = None
         if key is None:
             key = lambda obj: obj
         elif isinstance(key, str):
@@ -113,7 +516,50 @@ class UnionQuerySet(object):
                 return getattr(obj, attr)
             key = _sort_key
         clone.sort_key = key
+        clone.sort_attr = attr
         clone.sort_reverse = reverse
+        clone.chunk_size = chunk_size
+        return clone
+        
+    def seek(self, value, last=None):
+        """ 
+        Returns a clone that only contains objects sorted after `value` (keyset pagination). 
+        The filter is applied to each queryset, so `union.seek(last_value)[:n]` fetches at most `n` rows per queryset.
+        If the sort field is not unique, pass the last object of the previous page as `last`: objects with a sort value equal to `value` 
+        are ordered by queryset and pk (see `order_and_sort_by()`), and only those after `last` are included.
+        """
+        if not self.sort_attr:
+            raise TypeError("seek() requires a union sorted by a field name")
+        op = self.sort_reverse and 'lt' or 'gt'
+        after = Q(**{"%s__%s" % (self.sort_attr, op): value})
+        if last is None:
+            return self.filter(after)
+        try:
+            index = self.querysets.index(self.querysets_by_model[type(last)])
+        except KeyError:
+            raise ValueError("%r is not contained in this union" % last)
+        equal = Q(**{self.sort_attr: value})
+        querysets = []
+        for i, qs in enumerate(self.querysets):
+            if i < index:
+                q = after
+            elif i == index:
+                q = after | equal & Q(**{"pk__%s" % op: last.pk})
+            else:
+                q = after | equal
+            querysets.append(qs.filter(q))
+        return self._clone(querysets)
+        
+    def parallel(self, max_workers=4):
+        """ Returns a clone that evaluates its querysets concurrently on up to `max_workers` threads. """
+        clone = self._clone()
+        clone.max_workers = max_workers
+        return clone
+        
+    def sql_union(self):
+        """ Returns a clone that is evaluated with a single `UNION ALL` query, see `fetch_objects()`. """
+        clone = self._clone()
+        clone.use_sql_union = True
         return clone
         
     def __or__(self, other):
@@ -146,6 +592,13 @@ class UnionQuerySet(object):
             return get_query_set(model).none()
         return qs
             
+    @property
+    def db(self):
+        dbs = set(qs.db for qs in self.querysets)
+        if len(dbs) > 1:
+            raise ValueError("UnionQuerySet spans multiple databases: %s" % ", ".join(sorted(dbs)))
+        return dbs and dbs.pop() or DEFAULT_DB_ALIAS
+            
     @property
     def models(self):
         return [qs.model for qs in self.querysets]
@@ -154,14 +607,65 @@ class UnionQuerySet(object):
     def queries(self):
         return [qs.query for qs in self.querysets]
         
+    def _count_sql(self):
+        sql_queries = []
+        params = ()
+        for index, qs in enumerate(self.querysets):
+            if isinstance(qs, EmptyQuerySet):
+                continue
+            qs = qs.order_by()
+            try:
+                sql, qs_params = qs.query.get_compiler(qs.db).as_sql()
+            except EmptyResultSet:
+                continue
+            sql_queries.append('SELECT %d, COUNT(*) FROM (%s) AS %s' % (index, sql, connections[qs.db].ops.quote_name('count_%s' % index)))
+            params += qs_params
+        return ' UNION ALL '.join(sql_queries), params
+
+    def get_counts(self):
+        """ Returns a list of the number of rows in each queryset. The counts are fetched with a single query and cached. """
+        if self._counts is None:
+            try:
+                db = self.db
+            except ValueError:
+                self._counts = [qs.count() for qs in self.querysets]
+                return self._counts
+            counts = [0] * len(self.querysets)
+            sql, params = self._count_sql()
+            if sql:
+                cursor = connections[db].cursor()
+                cursor.execute(sql, params)
+                for index, count in cursor.fetchall():
+                    counts[index] = count
+            self._counts = counts
+        return self._counts
+
+    def count(self):
+        count = sum(self.get_counts())
+        start, stop = self.limits
+        if stop is not None:
+            count = min(count, stop)
+        if start:
+            count = max(count - start, 0)
+        return count
+
+    def __len__(self):
+        return self.count()
+        
     def __getitem__(self, k):
         if isinstance(k, (int, long)):
-            index = k
-            for qs in self.querysets:
-                try:
+            if self.sort_key:
+                for obj in itertools.islice(self, k, k + 1):
+                    return obj
+                raise IndexError
+            start, stop = self.limits
+            index = k + (start or 0)
+            if stop is not None and index >= stop:
+                raise IndexError
+            for qs, count in itertools.izip(self.querysets, self.get_counts()):
+                if index < count:
                     return qs[index]
-                except IndexError:
-                    index -= qs.count()
+                index -= count
             raise IndexError
         elif isinstance(k, slice):
             clone = self._clone()
@@ -174,56 +678,220 @@ class UnionQuerySet(object):
         return repr(list(self))
         
     def order_and_sort_by(self, attr):
-        return self.order_by(attr).sort(attr)
+        """ Orders each queryset by `attr` and pk, and merges them by `attr`. """
+        pk = attr.startswith('-') and '-pk' or 'pk'
+        return self.order_by(attr, pk).sort(attr)
         
     def get_common_fields(self, check_type=True, local=True):
-        model_fields = []
-        for queryset in self.querysets:
-            db = queryset.db
-            fields_with_dbtype = set((field.name, field.db_type(connection=connections[db])) for field in queryset.model._meta.fields)
-            model_fields.append(fields_with_dbtype)        
-        return tuple(name for name, db_type in reduce_and(model_fields))
+        if not self.querysets:
+            return ()
+        cache_key = tuple((qs.model, qs.db) for qs in self.querysets)
+        if cache_key not in _common_fields_cache:
+            model_fields = []
+            for model, db in cache_key:
+                fields_with_dbtype = [(field.name, field.db_type(connection=connections[db])) for field in model._meta.fields]
+                model_fields.append(fields_with_dbtype)
+            common = reduce_and(set(fields) for fields in model_fields)
+            # keep the field order of the first model
+            _common_fields_cache[cache_key] = tuple(name for name, db_type in model_fields[0] if (name, db_type) in common)
+        return _common_fields_cache[cache_key]
+
+    def _get_sort_column(self):
+        attr = self.sort_attr
+        if not attr:
+            if self.sort_key:
+                raise ValueError("sorting by a callable cannot be done in SQL, use sort() with a field name")
+            return None
+        opts = self.models[0]._meta
+        if attr == 'pk':
+            return opts.pk.name, opts.pk.column
+        return attr, opts.get_field(attr).column
 
     def as_sql(self, fields=None):
         if not fields:
             fields = self.get_common_fields()
+        fields = tuple(fields)
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        sort_column = self._get_sort_column()
+        if sort_column and sort_column[0] not in fields:
+            fields += (sort_column[0],)
         sql_queries = []
         params = ()
         for index, qs in enumerate(self.querysets):
-            values_qs = qs.extra(select={MODEL_COL: '%s'}, select_params=(index,)).values(MODEL_COL, *fields)            
-            sql, qs_params = values_qs.query.get_compiler(values_qs.db).as_sql()
+            if isinstance(qs, EmptyQuerySet):
+                continue
+            values_qs = qs.extra(select={MODEL_COL: '%s'}, select_params=(index,)).values(MODEL_COL, *fields).order_by()
+            try:
+                sql, qs_params = values_qs.query.get_compiler(values_qs.db).as_sql()
+            except EmptyResultSet:
+                continue
             sql_queries.append(sql)
-            params += qs_params                    
+            params += qs_params
+        if not sql_queries:
+            raise EmptyResultSet
 
-        sql = 'SELECT * FROM (%s)' % ' UNION '.join(sql_queries)
+        sql = 'SELECT * FROM (%s) AS %s' % (' UNION ALL '.join(sql_queries), qn('union_q'))
+        if sort_column:
+            # ties are broken by queryset order, as in sorted_union_generator()
+            sql += ' ORDER BY %s %s, %s' % (qn(sort_column[1]), self.sort_reverse and 'DESC' or 'ASC', qn(MODEL_COL))
+        start, stop = self.limits
+        if stop is not None:
+            sql += ' LIMIT %d' % max(stop - (start or 0), 0)
+        if start:
+            if stop is None:
+                val = connection.ops.no_limit_value()
+                if val:
+                    sql += ' LIMIT %d' % val
+            sql += ' OFFSET %d' % start
         return sql, params
         
-    def _execute_union(self, fields):
-        # TODO: handle ordering, cache results
-        # FIXME: this is horribly broken
-        sql, params = self.as_sql(fields)
+    def _get_aggregate_column(self, lookup):
+        if lookup == '*':
+            return None
+        opts = self.models[0]._meta
+        if lookup == 'pk':
+            return opts.pk.name, opts.pk.column
+        return lookup, opts.get_field(lookup).column
+
+    def _can_aggregate_in_sql(self, aggregates):
+        try:
+            connection = connections[self.db]
+        except ValueError:
+            return False
+        if self.sort_key and not self.sort_attr:
+            # a slice of a union sorted by a callable
+            return False
+        common_fields = self.get_common_fields()
+        for aggregate in aggregates:
+            lookup = aggregate.lookup
+            if lookup not in ('*', 'pk') and (LOOKUP_SEP in lookup or lookup not in common_fields):
+                return False
+        return True
+
+    def aggregate(self, *args, **kwargs):
+        """ 
+        Computes `Sum`, `Count`, `Min`, `Max`, and `Avg` aggregates across all querysets with a single query over their `UNION ALL`.
+        If that's not possible (lookups spanning relations, multiple databases), per-queryset aggregates are combined.
+        """
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        for alias, aggregate in kwargs.items():
+            if aggregate.name not in SQL_AGGREGATES:
+                raise TypeError("%s aggregates are not supported on UnionQuerySet" % aggregate.name)
+        if not kwargs:
+            return {}
+        if not self.querysets:
+            return _empty_aggregates(kwargs)
+        if self.sort_key and self.limits == (None, None):
+            # the order of an unsliced union doesn't affect its aggregates
+            unsorted = self._clone()
+            unsorted.sort_key = unsorted.sort_attr = None
+            return unsorted.aggregate(**kwargs)
+        if not self._can_aggregate_in_sql(kwargs.values()):
+            return self._combine_aggregates(kwargs)
+        
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        fields = []
+        columns = []
+        aliases = []
+        for alias, aggregate in kwargs.items():
+            column = self._get_aggregate_column(aggregate.lookup)
+            if column is None:
+                col_sql = '*'
+            else:
+                name, col = column
+                if name not in fields:
+                    fields.append(name)
+                col_sql = qn(col)
+            if aggregate.extra.get('distinct'):
+                col_sql = 'DISTINCT %s' % col_sql
+            columns.append('%s(%s)' % (SQL_AGGREGATES[aggregate.name], col_sql))
+            aliases.append(alias)
+        
+        try:
+            union_sql, params = self.as_sql(fields or [self.models[0]._meta.pk.name])
+        except EmptyResultSet:
+            return _empty_aggregates(kwargs)
+        sql = 'SELECT %s FROM (%s) AS %s' % (', '.join(columns), union_sql, qn('union_aggregate'))
         cursor = connection.cursor()
         cursor.execute(sql, params)
-        result = iter((lambda: cursor.fetchmany(GET_ITERATOR_CHUNK_SIZE)), connection.features.empty_fetchmany_value)
-        for chunk in result:
-            for row in chunk:
-                yield row[0], dict(zip(fields, row[1:]))
+        row = cursor.fetchone()
+        opts = self.models[0]._meta
+        result = {}
+        for alias, value in zip(aliases, row):
+            lookup = kwargs[alias].lookup
+            field = lookup in ('*', 'pk') and opts.pk or opts.get_field(lookup)
+            result[alias] = _convert_aggregate(connection, kwargs[alias], value, field)
+        return result
+
+    def _get_sliced_querysets(self):
+        """ Returns querysets that contain exactly the objects in `union[start:stop]`. """
+        start, stop = self.limits
+        if start is None and stop is None:
+            return self.querysets
+        if not self.sort_key:
+            return slice_querysets(self.querysets, self.get_counts(), start, stop)
+        # the slice depends on the merge order, so its objects have to be fetched
+        pks = [[] for qs in self.querysets]
+        for obj in self:
+            for index, qs in enumerate(self.querysets):
+                if isinstance(obj, qs.model):
+                    pks[index].append(obj.pk)
+                    break
+        return [qs.filter(pk__in=qs_pks) for qs, qs_pks in itertools.izip(self.querysets, pks) if qs_pks]
+
+    def _combine_aggregates(self, aggregates):
+        partial = {}
+        for alias, aggregate in aggregates.items():
+            if aggregate.name == 'Avg':
+                partial['%s__sum' % alias] = Sum(aggregate.lookup)
+                partial['%s__count' % alias] = Count(aggregate.lookup)
+            elif aggregate.name == 'Count' and aggregate.extra.get('distinct'):
+                raise TypeError("distinct counts cannot be combined across querysets")
+            else:
+                partial[alias] = aggregate
+        partials = [qs.aggregate(**partial) for qs in self._get_sliced_querysets()]
+        result = {}
+        for alias, aggregate in aggregates.items():
+            if aggregate.name == 'Avg':
+                total = _combine_partial_aggregates('Sum', [p['%s__sum' % alias] for p in partials])
+                count = _combine_partial_aggregates('Count', [p['%s__count' % alias] for p in partials])
+                result[alias] = None
+                if count:
+                    result[alias] = float(total) / count
+            else:
+                result[alias] = _combine_partial_aggregates(aggregate.name, [p[alias] for p in partials])
+        return result
+
+    def prepare(self, fields=None):
+        """ 
+        Returns a PreparedUnion for this union. Unions of unfiltered querysets are compiled once per process for their models, 
+        `fields`, limits, and sort order, other unions once per clone and `fields`.
+        """
+        if not fields:
+            fields = self.get_common_fields()
+        fields = tuple(fields)
+        if self.querysets and all(_is_unfiltered(qs) for qs in self.querysets):
+            cache_key = (tuple(self.models), self.db, fields, self.limits, self.sort_attr, self.sort_reverse)
+            prepared = prepared_union_cache.get(cache_key)
+            if prepared is None:
+                prepared = prepared_union_cache[cache_key] = PreparedUnion(self, fields)
+            return prepared
+        if fields not in self._prepared:
+            self._prepared[fields] = PreparedUnion(self, fields)
+        return self._prepared[fields]
         
     def fetch_values(self, fields=None):
-        if not fields:
-            fields = self.get_common_fields()        
-        for model_index, values in self._execute_union(fields):
-            yield values
+        return self.prepare(fields).fetch_values()
+                
+    def fetch_values_list(self, fields=None, flat=False):
+        """ As fetch_values(), but yields tuples (or single values if `flat=True`), see `QuerySet.values_list()`. """
+        return self.prepare(fields).fetch_values_list(flat=flat)
                 
     def fetch_objects(self, fields=None):
-        if not fields:
-            fields = self.get_common_fields()
-        deferred_models = []
-        for model in self.models:
-            skip = set(field.attname for field in model._meta.fields if not field.name in fields)
-            deferred_models.append(deferred_class_factory(model, skip))
-        for model_index, values in self._execute_union(fields):
-            yield deferred_models[model_index](**values)
+        return self.prepare(fields).fetch_objects()
         
     @classmethod
     def add_proxy(cls, name, return_map=None):
@@ -246,7 +914,5 @@ _proxy_methods = (
 for method in _proxy_methods:
     UnionQuerySet.add_proxy(method)
     
-UnionQuerySet.add_proxy('__len__', sum)
-UnionQuerySet.add_proxy('count', sum)
 UnionQuerySet.add_proxy('__nonzero__', any)
     
\ No newline at end of file
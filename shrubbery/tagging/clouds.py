@@ -1,19 +1,44 @@
+import copy
 import math
+import bisect
+import uuid
+from hashlib import sha1
+from itertools import izip
 from django.db import models
+from django.db.models.query import EmptyQuerySet
+from django.core.cache import get_cache
 from shrubbery.db.utils import get_query_set
 from shrubbery.db.union import UnionQuerySet
-from shrubbery.tagging.models import Tagged
+from shrubbery.tagging.models import Tag, Tagged, TaggedUnionQuerySet, tagging_settings, tag_counts_changed, get_count_types
+
+try:
+    import numpy
+    _ndarray = numpy.ndarray
+except ImportError:
+    numpy = None
+    _ndarray = ()
+
+# Distributions accept a single count or, if numpy is available, an array of counts.
 
 def LINEAR(count, min_count, max_count, avg_count):
     return count / float(max_count)
+LINEAR.vectorized = True
 
 def LOGARITHMIC(count, min_count, max_count, avg_count):
     if max_count == 1:
+        if isinstance(count, _ndarray):
+            return numpy.ones(len(count))
         return 1
+    if isinstance(count, _ndarray):
+        return numpy.log(count) / math.log(max_count)
     return math.log(count) / math.log(max_count)
+LOGARITHMIC.vectorized = True
 
 def COUNT(count, min_count, max_count, avg_count):
+    if isinstance(count, _ndarray):
+        return count.astype(int)
     return int(count)
+COUNT.vectorized = True
 
 class Annotation(object):
     def __init__(self, distribution=None, steps=None):
@@ -29,6 +54,22 @@ class Annotation(object):
                 return self.steps[-1]
             value = self.steps[int(value * len(self.steps))]
         return value
+        
+    def annotate(self, tags, counts, min_count, max_count, avg_count):
+        """
+        Returns a list of values for `tags` and their `counts`. If numpy is available, `counts` is an array 
+        and vectorized distributions are applied to all counts at once.
+        """
+        if numpy is None or type(self).__call__ != Annotation.__call__:
+            return [self(tag, count, min_count, max_count, avg_count) for tag, count in izip(tags, counts)]
+        if getattr(self.distribute, 'vectorized', False):
+            values = self.distribute(counts, min_count, max_count, avg_count)
+        else:
+            values = numpy.array([self.distribute(count, min_count, max_count, avg_count) for count in counts])
+        if self.steps:
+            indexes = numpy.minimum((values * len(self.steps)).astype(int), len(self.steps) - 1)
+            return [self.steps[index] for index in indexes]
+        return values.tolist()
 
     @classmethod
     def LINEAR(cls, **kwargs):
@@ -49,38 +90,189 @@ class Annotation(object):
 
 DEFAULT_ANNOTATIONS = {}
 
+GENERATION_CACHE_KEY = 'shrubbery.tagging.clouds.generation'
+
+def get_cloud_cache(cache=None):
+    if cache is None:
+        cache = tagging_settings.CLOUD_CACHE
+    if isinstance(cache, basestring):
+        cache = get_cache(cache)
+    return cache or None
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+def get_generation(cache):
+    generation = cache.get(GENERATION_CACHE_KEY)
+    if generation is None:
+        # concurrent processes agree on the generation that was added first
+        cache.add(GENERATION_CACHE_KEY, _new_generation())
+        generation = cache.get(GENERATION_CACHE_KEY)
+    return generation
+
+def invalidate_clouds(sender=None, **kwargs):
+    """ Invalidates all cached clouds by starting a new cache key generation. """
+    cache = get_cloud_cache()
+    if cache:
+        cache.set(GENERATION_CACHE_KEY, _new_generation())
+tag_counts_changed.connect(invalidate_clouds)
+
+##### 1-d clustering #####
+
+def _weighted_distinct(points):
+    values = sorted(set(points))
+    weights = dict((value, 0) for value in values)
+    for p in points:
+        weights[p] += 1
+    return values, [weights[value] for value in values]
+
+def optimal_kmeans_1d(points, k):
+    """
+    Returns a cluster index (in ascending order of cluster means) for each of `points`, such that the sum of squared 
+    distances to the cluster means is minimal. Dynamic programming over the sorted distinct values (Ckmeans.1d.dp), 
+    the optimal split points are monotone so each layer is solved by divide and conquer in O(n log n).
+    """
+    if not points:
+        return []
+    values, weights = _weighted_distinct(points)
+    n = len(values)
+    k = max(min(k, n), 1)
+    # prefix sums of weights, weighted values, and weighted squares
+    w_sum, x_sum, xx_sum = [0.0], [0.0], [0.0]
+    for value, weight in izip(values, weights):
+        w_sum.append(w_sum[-1] + weight)
+        x_sum.append(x_sum[-1] + weight * value)
+        xx_sum.append(xx_sum[-1] + weight * value * value)
+    def cost(i, j):
+        # sum of squared errors of values[i:j + 1]
+        w = w_sum[j + 1] - w_sum[i]
+        x = x_sum[j + 1] - x_sum[i]
+        return xx_sum[j + 1] - xx_sum[i] - x * x / w
+    
+    prev = [cost(0, j) for j in xrange(n)]
+    starts = [[0] * n]
+    for m in xrange(1, k):
+        cur = [None] * n
+        start = [0] * n
+        stack = [(m, n - 1, m, n - 1)]
+        while stack:
+            lo, hi, opt_lo, opt_hi = stack.pop()
+            if lo > hi:
+                continue
+            mid = (lo + hi) // 2
+            best, best_i = None, opt_lo
+            for i in xrange(max(opt_lo, m), min(mid, opt_hi) + 1):
+                c = prev[i - 1] + cost(i, mid)
+                if best is None or c < best:
+                    best, best_i = c, i
+            cur[mid], start[mid] = best, best_i
+            stack.append((lo, mid - 1, opt_lo, best_i))
+            stack.append((mid + 1, hi, best_i, opt_hi))
+        prev = cur
+        starts.append(start)
+
+    clusters = {}
+    j = n - 1
+    for m in xrange(k - 1, -1, -1):
+        i = starts[m][j]
+        for index in xrange(i, j + 1):
+            clusters[values[index]] = m
+        j = i - 1
+    return [clusters[p] for p in points]
+
+def lloyd_kmeans_1d(points, k, max_iterations=100):
+    """
+    Returns a cluster index (in ascending order of cluster means) for each of `points`, computed with at most 
+    `max_iterations` iterations of Lloyd's algorithm. In one dimension, each iteration is a search for the midpoints between means.
+    """
+    if not points:
+        return []
+    lo, hi = float(min(points)), float(max(points))
+    means = [lo + (hi - lo) * (i + 0.5) / k for i in xrange(k)]
+    if numpy is not None:
+        points = numpy.asarray(points, dtype=float)
+    assignment = None
+    for iteration in xrange(max_iterations):
+        bounds = [(a + b) / 2.0 for a, b in izip(means, means[1:])]
+        if numpy is not None:
+            new_assignment = numpy.searchsorted(bounds, points)
+            if assignment is not None and (new_assignment == assignment).all():
+                break
+            assignment = new_assignment
+            counts = numpy.bincount(assignment, minlength=k)
+            sums = numpy.bincount(assignment, weights=points, minlength=k)
+            # empty clusters keep their mean
+            means = numpy.where(counts > 0, sums / numpy.maximum(counts, 1), means).tolist()
+        else:
+            new_assignment = [bisect.bisect_left(bounds, p) for p in points]
+            if new_assignment == assignment:
+                break
+            assignment = new_assignment
+            counts, sums = [0] * k, [0.0] * k
+            for index, p in izip(assignment, points):
+                counts[index] += 1
+                sums[index] += p
+            means = [counts[i] and sums[i] / counts[i] or means[i] for i in xrange(k)]
+    return list(assignment)
+
+
 class Cloud(object):    
     def __init__(self, queryset=None, tags=None, **kwargs):
         self.union = isinstance(queryset, UnionQuerySet)
         self.threshold = kwargs.pop('threshold', 0)
         self.annotations = kwargs.pop('annotations', DEFAULT_ANNOTATIONS)
         self.range_adjusted = kwargs.pop('range_adjusted', True)
-        if queryset:
+        self.cache = get_cloud_cache(kwargs.pop('cache', None))
+        self.cache_timeout = kwargs.pop('cache_timeout', tagging_settings.CLOUD_CACHE_TIMEOUT)
+        if queryset is not None:
             if not self.union:
                 queryset = get_query_set(queryset)            
-            if tags:
+        else:
+            queryset = TaggedUnionQuerySet(Tagged)
+            self.union = True
+        self.queryset = queryset
+        types = None
+        if tagging_settings.MATERIALIZED_COUNTS:
+            types = get_count_types(queryset)
+        if types is not None:
+            if tags is None:
+                tags = Tag.objects.all()
+            self.tags = tags.filter(counts__type__in=types, counts__count__gt=0).annotate(_count=models.Sum('counts__count'))
+        else:
+            if isinstance(queryset, EmptyQuerySet):
+                tags = Tag.objects.none()
+            elif tags:
                 tags = tags & queryset.tags()
             else:
                 tags = queryset.tags()
-            self.queryset = queryset
-        else:
-            self.queryset = UnionQuerySet(Tagged)
-            self.union = True
-        self.tags = tags.annotate(_count=models.Count('object_set')).order_by('-_count')
+            self.tags = tags.annotate(_count=models.Count('object_set'))
+        self.tags = self.tags.order_by('-_count')
         if self.threshold:
             self.tags = self.tags.filter(_count__gte=self.threshold)
         
     @property
     def cache_key(self):
-        from hashlib import sha1
-        return "cloud_%s" % sha1("%s;%s" % (str(self.tags.query), repr(self.annotations))).hexdigest()
+        key = sha1("%s;%s" % (str(self.tags.query), repr(self.annotations))).hexdigest()
+        if self.cache:
+            return "cloud_%s_%s" % (get_generation(self.cache), key)
+        return "cloud_%s" % key
+        
+    def get_tags(self):
+        """ Returns a list of tags with their counts, from the cache if available. """
+        if not self.cache:
+            return list(self.tags)
+        key = self.cache_key
+        tags = self.cache.get(key)
+        if tags is None:
+            tags = list(self.tags)
+            self.cache.set(key, tags, self.cache_timeout)
+        return tags
 
     def clone(self, tags=None):
-        clone = object()
-        clone.__class__ = type(self)
-        clone.tags = tags or self.tags
-        clone.annotations = self.annotations
-        clone.range_adjusted = clone.range_adjusted
+        clone = copy.copy(self)
+        clone.__dict__.pop('_cloud', None)
+        if tags is not None:
+            clone.tags = tags
         return clone
         
     def __getitem__(self, key):
@@ -96,22 +288,29 @@ class Cloud(object):
     @property
     def cloud(self):
         if not hasattr(self, '_cloud'):
-            tags = list(self.tags)
+            tags = self.get_tags()
             if not tags:
                 max_count = 1
             else:
                 min_count = float(tags[-1]._count)
                 max_count = float(tags[0]._count)
-                avg_count = float(sum(tag._count for tag in tags)) / len(tags)
                 tags.sort(key=lambda tag: tag.name)
+                if numpy is not None:
+                    counts = numpy.fromiter((tag._count for tag in tags), dtype=float, count=len(tags))
+                    avg_count = counts.mean()
+                    if self.range_adjusted:
+                        counts = counts - min_count + 1
+                else:
+                    counts = [tag._count for tag in tags]
+                    avg_count = float(sum(counts)) / len(tags)
+                    if self.range_adjusted:
+                        counts = [count - min_count + 1 for count in counts]
                 if self.range_adjusted:
                     max_count = max_count - min_count + 1
-                for tag in tags:
-                    count = tag._count
-                    if self.range_adjusted:
-                        count = count - min_count + 1
-                    for attr, annotation in self.annotations.items():
-                        setattr(tag, attr, annotation(tag, count, min_count, max_count, avg_count))        
+                for attr, annotation in self.annotations.items():
+                    values = annotation.annotate(tags, counts, min_count, max_count, avg_count)
+                    for tag, value in izip(tags, values):
+                        setattr(tag, attr, value)
             self._cloud = tags
             self.max_count = max_count
         return self._cloud
@@ -119,11 +318,27 @@ class Cloud(object):
     def __iter__(self):
         return iter(self.cloud)
         
-    def kmeans(self, k, point=lambda t: t.count, metric=lambda a,b: abs(a-b)):
+    def kmeans(self, k, point=lambda t: t.count, metric=None, max_iterations=100, optimal=False):
+        """
+        Clusters the tags of this cloud by `point(tag)` into `k` sets, ordered by their mean. 
+        With `optimal=True`, the clustering minimizes the sum of squared distances exactly, 
+        otherwise Lloyd's algorithm runs for at most `max_iterations` iterations. 
+        A custom `metric` uses the generic (slow) algorithm.
+        """
         tags = self.cloud
+        if metric is None:
+            points = [point(tag) for tag in tags]
+            if optimal:
+                assignment = optimal_kmeans_1d(points, k)
+            else:
+                assignment = lloyd_kmeans_1d(points, k, max_iterations)
+            clusters = [set() for i in range(k)]
+            for tag, index in izip(tags, assignment):
+                clusters[index].add(tag)
+            return clusters
         means = [1 + (self.max_count-1)*float(i)/k for i in range(k)]
         prev_clusters = None
-        while True:
+        for iteration in xrange(max_iterations):
             clusters = [set() for i in range(k)]
             for tag in tags:
                 p = point(tag)
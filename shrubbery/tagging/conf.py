@@ -0,0 +1,14 @@
+from shrubbery.conf import Settings, Setting, BooleanSetting, IntSetting
+
+
+class settings(Settings):
+    MATERIALIZED_COUNTS = BooleanSetting(default=False)
+    MATERIALIZED_COOCCURRENCES = BooleanSetting(default=False)
+    CLOUD_CACHE = Setting(default=None)
+    CLOUD_CACHE_TIMEOUT = Setting(default=None)
+    MAX_QUERY_CLAUSES = IntSetting(default=64)
+    TAG_NAME_CACHE_SIZE = IntSetting(default=10000)
+    SIMILARITY_INDEX = BooleanSetting(default=False)
+    SIMILAR_OBJECT_CANDIDATES = IntSetting(default=100)
+    MINHASH_BANDS = IntSetting(default=16)
+    MINHASH_ROWS = IntSetting(default=4)
@@ -1,21 +1,298 @@
 import math
+from abc import ABCMeta, abstractmethod
+from itertools import izip
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Sum
 from shrubbery.db.utils import get_query_set
-from shrubbery.tagging.models import Tag
+from shrubbery.polymorph.models import ObjectIdentity
+from shrubbery.tagging.models import Tag, TagCount, TagCooccurrence, get_tag_through, get_count_types, tagging_settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Measures are computed from the co-occurrence count of a and b, the counts of a and b, and the total number of objects.
+# They accept floats or, if numpy is available, arrays.
+
+def JACCARD(ab, a, b, total):
+    return ab / (a + b - ab)
+
+def COSINE(ab, a, b, total):
+    return ab / (a * b) ** 0.5
+
+def PROBABILITY(ab, a, b, total):
+    """ The probability of b given a. """
+    return ab / a
+
+def IMPLIES(ab, a, b, total):
+    return ab == a
+
+MEASURES = {
+    'jaccard': JACCARD,
+    'cosine': COSINE,
+    'probability': PROBABILITY,
+    'implies': IMPLIES,
+}
+
+def _tag_id(tag):
+    return getattr(tag, 'pk', tag)
+
+
+class Cooccurrences(object):
+    """ 
+    Abstract base of sparse tag x tag co-occurrence counts. Subclasses provide `entries` ({(tag_a, tag_b): count}), `tag_counts` ({tag: count}), 
+    `total`, and `_load_tag_counts()` for tags outside the computed rows.
+    """
+    __metaclass__ = ABCMeta
+    complete = True
+    
+    def _set_entries(self, rows):
+        self.entries = {}
+        self.rows = {}
+        for a, b, count in rows:
+            self.entries[a, b] = count
+            self.rows.setdefault(a, {})[b] = count
+        self.tag_ids = sorted(self.rows)
+        
+    @abstractmethod
+    def _load_tag_counts(self):
+        """ Loads `tag_counts` for all tags and sets `complete`. """
+
+    def __len__(self):
+        return len(self.tag_ids)
+
+    def count(self, a, b=None):
+        """ Returns the number of objects tagged with `a` (and `b`). """
+        a = _tag_id(a)
+        if b is None or _tag_id(b) == a:
+            if a not in self.tag_counts and not self.complete:
+                self._load_tag_counts()
+            return self.tag_counts.get(a, 0)
+        return self.entries.get((a, _tag_id(b)), 0)
+
+    def row(self, tag):
+        """ Returns a dict that maps tag ids to co-occurrence counts with `tag`. """
+        return dict(self.rows.get(_tag_id(tag), ()))
+
+    def measure(self, measure, a, b):
+        measure = MEASURES.get(measure, measure)
+        count_a, count_b = self.count(a), self.count(b)
+        if not count_a or not count_b:
+            return 0.0
+        return measure(float(self.count(a, b)), float(count_a), float(count_b), float(self.total))
+
+    def jaccard(self, a, b):
+        return self.measure(JACCARD, a, b)
+
+    def cosine(self, a, b):
+        return self.measure(COSINE, a, b)
+
+    def probability(self, a, given=None):
+        if given is None:
+            return self.count(a) / float(self.total or 1)
+        return self.measure(PROBABILITY, given, a)
+
+    def implies(self, a, b):
+        return bool(self.measure(IMPLIES, a, b))
+
+    def profile_cosine(self, a, b, tags=None):
+        """ The cosine of the co-occurrence rows of `a` and `b`, ignoring columns `a` and `b`, and all columns not in `tags` if given. """
+        a, b = _tag_id(a), _tag_id(b)
+        row_a, row_b = self.row(a), self.row(b)
+        if tags is not None:
+            tag_ids = set(_tag_id(tag) for tag in tags)
+            row_a = dict((t, count) for t, count in row_a.iteritems() if t in tag_ids)
+            row_b = dict((t, count) for t, count in row_b.iteritems() if t in tag_ids)
+        for row in (row_a, row_b):
+            row.pop(a, None)
+            row.pop(b, None)
+        p = sum(count * row_b.get(t, 0) for t, count in row_a.iteritems())
+        if not p:
+            return 0
+        n_a = sum(count ** 2 for count in row_a.itervalues())
+        n_b = sum(count ** 2 for count in row_b.itervalues())
+        return p / (math.sqrt(n_a) * math.sqrt(n_b))
+
+    def pairs(self, measure='jaccard'):
+        """
+        Returns a list of `(tag_id_a, tag_id_b, value)` for all pairs of co-occurring tags.
+        `measure` is computed for all pairs at once if numpy is available.
+        """
+        measure = MEASURES.get(measure, measure)
+        if not self.complete:
+            self._load_tag_counts()
+        pairs = self.entries.keys()
+        if not pairs:
+            return []
+        total = float(self.total)
+        if numpy is not None:
+            ab = numpy.fromiter((self.entries[pair] for pair in pairs), dtype=float, count=len(pairs))
+            a = numpy.fromiter((self.tag_counts[pair[0]] for pair in pairs), dtype=float, count=len(pairs))
+            b = numpy.fromiter((self.tag_counts[pair[1]] for pair in pairs), dtype=float, count=len(pairs))
+            values = measure(ab, a, b, total).tolist()
+        else:
+            values = [measure(float(self.entries[pair]), float(self.tag_counts[pair[0]]), float(self.tag_counts[pair[1]]), total) for pair in pairs]
+        return [(a, b, value) for (a, b), value in izip(pairs, values)]
+
+
+def _count_tagged_objects(types=None, db=DEFAULT_DB_ALIAS, where=(), params=()):
+    """ 
+    Returns the number of distinct objects in the tag relation table `t`, only of the given `types` if not None, 
+    and only those that satisfy the conditions `where` (with `params`).
+    """
+    opts = get_tag_through()._meta
+    connection = connections[db]
+    qn = connection.ops.quote_name
+    obj_col = qn(opts.get_field('obj').column)
+    where, params = list(where), list(params)
+    join = ""
+    if types is not None:
+        type_ids = [getattr(t, 'pk', t) for t in types]
+        if not type_ids:
+            return 0
+        identity_opts = ObjectIdentity._meta
+        join = "INNER JOIN %s i ON t.%s = i.%s" % (qn(identity_opts.db_table), obj_col, qn(identity_opts.pk.column))
+        where.append("i.%s IN (%s)" % (qn(identity_opts.get_field('type').column), ", ".join(["%s"] * len(type_ids))))
+        params.extend(type_ids)
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(DISTINCT t.%s) FROM %s t %s %s" % (
+        obj_col, qn(opts.db_table), join, where and "WHERE %s" % " AND ".join(where) or "",
+    ), params)
+    return cursor.fetchone()[0]
+
+
+class CooccurrenceMatrix(Cooccurrences):
+    """
+    The sparse tag x tag matrix of co-occurrence counts for the objects in `queryset` (or all tagged objects),
+    computed with a single grouped self-join of the tag relation table. The diagonal holds the number of objects per tag.
+    If `tags` are given, only their rows are computed.
+    """
+    def __init__(self, queryset=None, tags=None):
+        self.db = DEFAULT_DB_ALIAS
+        self.queryset = queryset
+        if queryset is not None:
+            self.queryset = queryset = get_query_set(queryset)
+            self.db = queryset.db
+        self.complete = tags is None
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = get_tag_through()._meta
+        obj_col = qn(opts.get_field('obj').column)
+        tag_col = qn(opts.get_field('rel_obj').column)
+        where, params = self._restrict_objects("a.%s" % obj_col)
+        if tags is not None:
+            tag_ids = [_tag_id(tag) for tag in tags]
+            where.append("a.%s IN (%s)" % (tag_col, ", ".join(["%s"] * len(tag_ids))))
+            params.extend(tag_ids)
+        cursor = connection.cursor()
+        cursor.execute("SELECT a.%s, b.%s, COUNT(*) FROM %s a INNER JOIN %s b ON a.%s = b.%s %s GROUP BY a.%s, b.%s" % (
+            tag_col, tag_col,
+            qn(opts.db_table), qn(opts.db_table), obj_col, obj_col,
+            where and "WHERE %s" % " AND ".join(where) or "",
+            tag_col, tag_col,
+        ), params)
+        rows = cursor.fetchall()
+        where, params = self._restrict_objects("t.%s" % obj_col)
+        self.total = _count_tagged_objects(db=self.db, where=where, params=params)
+        self.tag_counts = dict((a, count) for a, b, count in rows if a == b)
+        self._set_entries((a, b, count) for a, b, count in rows if a != b)
+
+    def _restrict_objects(self, col):
+        if self.queryset is None:
+            return [], []
+        sql, params = self.queryset.values_list('pk', flat=True).query.get_compiler(self.db).as_sql()
+        return ["%s IN (%s)" % (col, sql)], list(params)
+        
+    def _load_tag_counts(self):
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = get_tag_through()._meta
+        tag_col = qn(opts.get_field('rel_obj').column)
+        where, params = self._restrict_objects(qn(opts.get_field('obj').column))
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s, COUNT(*) FROM %s %s GROUP BY %s" % (
+            tag_col, qn(opts.db_table), where and "WHERE %s" % " AND ".join(where) or "", tag_col,
+        ), params)
+        self.tag_counts = dict(cursor.fetchall())
+        self.complete = True
+        
+
+class StoredCooccurrences(Cooccurrences):
+    """
+    Co-occurrence counts read from the materialized :class:`TagCooccurrence` and :class:`TagCount` tables, 
+    for objects of the given `types` (or all types). If `tags` are given, only their rows are loaded.
+    """
+    def __init__(self, types=None, tags=None):
+        self.types = types
+        self.complete = tags is None
+        rows = TagCooccurrence.objects.filter(count__gt=0)
+        counts = TagCount.objects.filter(count__gt=0)
+        if types is not None:
+            rows = rows.filter(type__in=types)
+            counts = counts.filter(type__in=types)
+        if tags is not None:
+            tag_ids = [_tag_id(tag) for tag in tags]
+            rows = rows.filter(tag_a__in=tag_ids)
+            counts = counts.filter(tag__in=tag_ids)
+        self.tag_counts = dict(counts.values_list('tag').annotate(Sum('count')).order_by())
+        self._set_entries(rows.values_list('tag_a', 'tag_b').annotate(Sum('count')).order_by())
+        
+    def _load_tag_counts(self):
+        counts = TagCount.objects.filter(count__gt=0)
+        if self.types is not None:
+            counts = counts.filter(type__in=self.types)
+        self.tag_counts = dict(counts.values_list('tag').annotate(Sum('count')).order_by())
+        self.complete = True
+
+    @property
+    def total(self):
+        if not hasattr(self, '_total'):
+            self._total = _count_tagged_objects(self.types)
+        return self._total
+
+
+def get_cooccurrences(queryset=None, tags=None):
+    """ 
+    Returns :class:`StoredCooccurrences` if the materialized tables describe `queryset` (all tagged objects if None), 
+    a :class:`CooccurrenceMatrix` otherwise.
+    """
+    if tagging_settings.MATERIALIZED_COOCCURRENCES and tagging_settings.MATERIALIZED_COUNTS:
+        if queryset is None:
+            return StoredCooccurrences(tags=tags)
+        types = get_count_types(get_query_set(queryset))
+        if types is not None:
+            return StoredCooccurrences(types, tags=tags)
+    return CooccurrenceMatrix(queryset, tags=tags)
+
+
+def _is_tag(x):
+    return isinstance(x, Tag)
 
 def _count(q, queryset=None):
-    if queryset:
-        queryset = get_query_set(queryset)
-        if q:
-            queryset = queryset.complex_filter(q)
-        return float(queryset.count())
-    else:
-        return Tag.objects.object_set().filter(TagQ(q, field='object_set__tags'))
+    queryset = get_query_set(queryset)
+    if q:
+        queryset = queryset.complex_filter(q)
+    return float(queryset.count())
 
 def jaccard(a, b, queryset=None):
+    if _is_tag(a) and _is_tag(b):
+        return get_cooccurrences(queryset, tags=[a, b]).jaccard(a, b)
     return _count(a & b, queryset) / _count(a | b, queryset)
-    
+
+def _tag_ids_of_objects_tagged_with(a, b, queryset=None):
+    through = get_tag_through()
+    objects = through.objects.filter(rel_obj=_tag_id(a), obj__in=through.objects.filter(rel_obj=_tag_id(b)).values('obj'))
+    if queryset is not None:
+        objects = objects.filter(obj__in=get_query_set(queryset).values('pk'))
+    return through.objects.filter(obj__in=objects.values('obj')).values_list('rel_obj', flat=True).distinct()
+
 def cossim(a, b, queryset=None):
     "cossim(a, b) = arccos(v_a, v_b) = (v_a * v_b)/(|v_a|*|v_b|) for v_x[t] = w(x, t)"
+    # t ranges over the other tags of objects that match both a and b
+    if _is_tag(a) and _is_tag(b):
+        tags = _tag_ids_of_objects_tagged_with(a, b, queryset)
+        return get_cooccurrences(queryset, tags=[a, b]).profile_cosine(a, b, tags=tags)
     queryset = get_query_set(queryset)
     p, n_a, n_b = 0, 0, 0
     for t in queryset.complex_filter(a & b).tags():
@@ -29,16 +306,17 @@ def cossim(a, b, queryset=None):
     if p == 0:
         return 0
     return p / (math.sqrt(n_a) * math.sqrt(n_b))
-    
+
 def dijunct(a, b, queryset=None):
-    return _count(a & b) == 0
-    
+    return _count(a & b, queryset) == 0
+
 def probability(a, given=None, queryset=None):
     if not given:
         return _count(a, queryset) / _count(None, queryset)
+    elif _is_tag(a) and _is_tag(given):
+        return get_cooccurrences(queryset, tags=[given, a]).probability(a, given=given)
     else:
         return _count(a & given, queryset) / _count(given, queryset)
 
 def implies(a, b, queryset=None):
     return probability(b, given=a, queryset=queryset) == 1
-
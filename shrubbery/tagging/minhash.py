@@ -0,0 +1,44 @@
+import random
+
+# hash values are computed modulo a Mersenne prime, band hashes have to fit into a signed 32 bit integer column
+PRIME = (1 << 61) - 1
+BAND_HASH_MODULUS = (1 << 31) - 1
+
+
+class MinHash(object):
+    """
+    MinHash signatures of integer sets (tag ids) with `bands` * `rows` hash functions. Sets that share a band hash are candidates for
+    similar sets: a pair with Jaccard similarity `s` shares at least one band with probability `1 - (1 - s ** rows) ** bands`.
+    """
+    def __init__(self, bands=16, rows=4, seed=0):
+        self.bands = bands
+        self.rows = rows
+        rnd = random.Random(seed)
+        self.hash_functions = [(rnd.randint(1, PRIME - 1), rnd.randint(0, PRIME - 1)) for i in xrange(bands * rows)]
+
+    @property
+    def threshold(self):
+        """ The approximate similarity at which a pair becomes more likely than not to be a candidate. """
+        return (1.0 / self.bands) ** (1.0 / self.rows)
+
+    def signature(self, ids):
+        return [min((a * x + b) % PRIME for x in ids) for a, b in self.hash_functions]
+
+    def band_hashes(self, ids):
+        """ Returns a list of `(band, hash)` pairs for `ids`, or an empty list if `ids` is empty. """
+        if not ids:
+            return []
+        signature = self.signature(ids)
+        result = []
+        for band in xrange(self.bands):
+            h = band
+            for value in signature[band * self.rows:(band + 1) * self.rows]:
+                h = (h * 1000003 ^ value) % BAND_HASH_MODULUS
+            result.append((band, h))
+        return result
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 0.0
+    return len(a & b) / float(len(a | b))
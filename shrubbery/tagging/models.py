@@ -1,22 +1,65 @@
-from django.db import models
+import heapq
+import itertools
+from collections import defaultdict
+from operator import itemgetter
+from django.db import models, connection, connections, router, transaction, IntegrityError
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql import DeleteQuery
+from django.db.models.sql.where import WhereNode, Constraint, AND
+from django.dispatch import Signal
+from shrubbery.conf import settings
 from shrubbery.tagging.encoding import parse_tags, encode_tags
+from shrubbery.tagging.minhash import MinHash, jaccard
 from shrubbery import polymorph
+from shrubbery.polymorph.models import ObjectIdentity
 from shrubbery.db.managers import Manager
 from shrubbery.db.many_related_join import ManyRelatedJoinQ
 from shrubbery.db.utils import get_sub_models, ImplicitQMixin
 from shrubbery.db.union import UnionQuerySet
-from shrubbery.utils import reduce_or
+from shrubbery.db.transaction import commit_on_success_unless_managed
+from shrubbery.utils import reduce_or, LRUCache
+
+tagging_settings = settings['shrubbery.tagging']
+
+# Maps tag names to the ids of committed tags, maintained by get_tag(), get_tags(), and the signal handlers below.
+tag_name_cache = LRUCache(tagging_settings.TAG_NAME_CACHE_SIZE)
+
+minhash = MinHash(tagging_settings.MINHASH_BANDS, tagging_settings.MINHASH_ROWS)
+
+# Sent after tags have been assigned to or removed from objects, and after the materialized tag counts (if any) have been updated.
+tag_counts_changed = Signal()
 
 ##### managers, querysets, and q-objects #####
 
 class TaggedQuerySet(models.query.QuerySet):
+    _prefetch_tags = False
+    
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_prefetch_tags', self._prefetch_tags)
+        return super(TaggedQuerySet, self)._clone(*args, **kwargs)
+        
+    def iterator(self):
+        objects = super(TaggedQuerySet, self).iterator()
+        if self._prefetch_tags:
+            return iter_with_prefetched_tags(objects)
+        return objects
+        
+    @Manager.proxy_method
+    def prefetch_tags(self):
+        """ Returns a clone that loads the tags of its objects with one query per 500 objects. """
+        return self._clone(_prefetch_tags=True)
+    
     @Manager.proxy_method
     def tags(self):
         return Tag.objects.filter(object_set__in=self).distinct()
         
     @Manager.proxy_method
     def with_similar_tags(self, obj):
-        return self.filter(tags__in=obj.tags.all()).annotate(common_tag_count=models.Count('tags')).filter(common_tag_count__gt=0).order_by('-common_tag_count')
+        """ With `SIMILARITY_INDEX`, only objects that share a band of their MinHash signature with `obj` are counted. """
+        qs = self
+        if tagging_settings.SIMILARITY_INDEX:
+            qs = qs.filter(pk__in=get_similarity_candidates(get_tag_ids(obj)))
+        return qs.filter(tags__in=obj.tags.all()).annotate(common_tag_count=models.Count('tags')).filter(common_tag_count__gt=0).order_by('-common_tag_count')
         
     @Manager.proxy_method
     def common_tags(self):
@@ -27,29 +70,157 @@ class TaggedQuerySet(models.query.QuerySet):
     def coverage(self, tags):
         return self.filter(tags__in=tags.values('pk').query).count() / float(self.count())
         
+    @Manager.proxy_method
+    @commit_on_success_unless_managed
+    def add_tags(self, *tags):
+        """ Tags all objects in this queryset with `tags`, using one INSERT ... SELECT statement per tag. """
+        for tag_id in set(_resolve_tag_ids(tags)):
+            change_tag_assignments(self, tag_id, 1)
+            
+    @Manager.proxy_method
+    @commit_on_success_unless_managed
+    def remove_tags(self, *tags):
+        """ Removes `tags` from all objects in this queryset, using one DELETE statement per tag. """
+        for tag_id in set(_resolve_tag_ids(tags)):
+            change_tag_assignments(self, tag_id, -1)
+            
+    @Manager.proxy_method
+    @commit_on_success_unless_managed
+    def set_tags(self, mapping):
+        """ 
+        Makes `mapping[obj]` the tags of each `obj` (an instance or a pk) in `mapping` that is in this queryset. 
+        The current assignments are loaded with one query (per 500 objects), then objects are grouped by tag, 
+        so each added or removed tag costs one INSERT ... SELECT or DELETE statement (per 500 objects).
+        """
+        assignments = {}
+        for obj, tags in mapping.iteritems():
+            if isinstance(tags, basestring):
+                tags = parse_tags(tags)
+            assignments[getattr(obj, 'pk', obj)] = list(tags)
+        names = list(set(tag for tags in assignments.itervalues() for tag in tags if isinstance(tag, basestring)))
+        tag_ids = dict(zip(names, _resolve_tag_ids(names)))
+        tag_pks = defaultdict(set)
+        for pk, tags in assignments.iteritems():
+            for tag in tags:
+                if isinstance(tag, basestring):
+                    tag = tag_ids[tag]
+                tag_pks[getattr(tag, 'pk', tag)].add(pk)
+        current = defaultdict(set)
+        through = get_tag_through()
+        for chunk in _chunks(assignments):
+            for obj_id, tag_id in through.objects.filter(obj__in=chunk).values_list('obj', 'rel_obj'):
+                current[tag_id].add(obj_id)
+        for tag_id in set(tag_pks).union(current):
+            for chunk in _chunks(current[tag_id].difference(tag_pks[tag_id])):
+                change_tag_assignments(self.filter(pk__in=chunk), tag_id, -1)
+            for chunk in _chunks(tag_pks[tag_id].difference(current[tag_id])):
+                change_tag_assignments(self.filter(pk__in=chunk), tag_id, 1)
+        
     
 class TagFieldManager(Manager):
-    def add(self, *tags):
-        return super(TagFieldManager, self).add(*[get_tag(tag) for tag in tags])
-
+    def all(self):
+        qs = super(TagFieldManager, self).all()
+        tags = getattr(self.instance, '_prefetched_tags', None)
+        if tags is not None:
+            qs._result_cache = list(tags)
+        return qs
+        
+    def _forget_prefetched_tags(self):
+        self.instance.__dict__.pop('_prefetched_tags', None)
+        
     def assign(self, tags):
+        """ Makes `tags` the tags of the related object. Only the difference to its current tags is inserted and deleted. """
         if isinstance(tags, (str, unicode)):
             tags = parse_tags(tags)
-        self.clear()
-        self.add(*tags)
+        tag_ids = set(_resolve_tag_ids(tags))
+        db = router.db_for_write(self.through, instance=self.instance)
+        current = self.through._default_manager.using(db).filter(**{self.source_field_name: self._pk_val})
+        current_ids = set(current.values_list(self.target_field_name, flat=True))
+        self._forget_prefetched_tags()
+        self._delete_tag_ids(current_ids - tag_ids, db)
+        self._insert_tag_ids(tag_ids - current_ids, db)
+        
+    def _send_m2m_changed(self, action, tag_ids, db):
+        models.signals.m2m_changed.send(sender=self.through, action=action, instance=self.instance, reverse=self.reverse, model=self.model, pk_set=tag_ids, using=db)
+        
+    def _insert_tag_ids(self, tag_ids, db):
+        if not tag_ids:
+            return
+        self._send_m2m_changed('pre_add', tag_ids, db)
+        opts = self.through._meta
+        qn = connections[db].ops.quote_name
+        cursor = connections[db].cursor()
+        cursor.executemany("INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+            qn(opts.db_table), qn(opts.get_field(self.source_field_name).column), qn(opts.get_field(self.target_field_name).column),
+        ), [(self._pk_val, tag_id) for tag_id in tag_ids])
+        transaction.commit_unless_managed(using=db)
+        self._send_m2m_changed('post_add', tag_ids, db)
+        
+    def _delete_tag_ids(self, tag_ids, db):
+        if not tag_ids:
+            return
+        self._send_m2m_changed('pre_remove', tag_ids, db)
+        opts = self.through._meta
+        where = WhereNode()
+        where.add((Constraint(None, opts.get_field(self.source_field_name).column, None), 'exact', self._pk_val), AND)
+        where.add((Constraint(None, opts.get_field(self.target_field_name).column, None), 'in', list(tag_ids)), AND)
+        DeleteQuery(self.through).do_query(opts.db_table, where, using=db)
+        transaction.commit_unless_managed(using=db)
+        self._send_m2m_changed('post_remove', tag_ids, db)
 
     def __unicode__(self):
         return encode_tags(self.all())        
         
+def resolve_tag_arguments(cls):
+    """ Decorates a related manager class: `add()` and `remove()` accept tag names (resolved with a single query) besides tags and ids. """
+    class TagRelatedManager(cls):
+        def add(self, *tags):
+            self._forget_prefetched_tags()
+            super(TagRelatedManager, self).add(*_resolve_tag_names(tags))
+            
+        def remove(self, *tags):
+            self._forget_prefetched_tags()
+            super(TagRelatedManager, self).remove(*_resolve_tag_names(tags))
+            
+        def clear(self):
+            self._forget_prefetched_tags()
+            super(TagRelatedManager, self).clear()
+    return TagRelatedManager
+        
 TaggedManager = polymorph.ObjectManager.for_queryset(TaggedQuerySet)
 
 class TaggedUnionQuerySet(UnionQuerySet):
+    _prefetch_tags = False
+    
+    def _clone(self, querysets=None):
+        clone = super(TaggedUnionQuerySet, self)._clone(querysets=querysets)
+        clone._prefetch_tags = self._prefetch_tags
+        return clone
+        
+    def prefetch_tags(self):
+        """ Returns a clone that loads the tags of its objects (of all models) with one query per 500 objects. """
+        clone = self._clone()
+        clone._prefetch_tags = True
+        return clone
+        
+    def __iter__(self):
+        objects = super(TaggedUnionQuerySet, self).__iter__()
+        if self._prefetch_tags:
+            return iter_with_prefetched_tags(objects)
+        return objects
+        
+    def iterator(self):
+        objects = super(TaggedUnionQuerySet, self).iterator()
+        if self._prefetch_tags:
+            return iter_with_prefetched_tags(objects)
+        return objects
+
     def tags(self):
         return reduce_or(qs.tags() for qs in self.querysets)
         
     def coverage(self, tags):
         tag_pk_query = tags.values('pk').query        
-        return sum(qs.filter(tags__in=tag_pk_query).count() for qs in self.querysets) / float(self.count())
+        return self.filter(tags__in=tag_pk_query).count() / float(self.count())
 
 
 ##### models #####
@@ -71,19 +242,145 @@ class TagQ(ManyRelatedJoinQ):
     model = Tag
     field = 'tags'        
 
+    @property
+    def max_clauses(self):
+        return tagging_settings.MAX_QUERY_CLAUSES
+
+
+class TagCountManager(models.Manager):
+    def rebuild(self):
+        """ 
+        Recomputes all counts from the tag relation table. Only assignments of existing objects are counted, 
+        just like the signal handlers subtract the tags of deleted objects.
+        """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        through_opts = get_tag_through()._meta
+        tag_col = qn(through_opts.get_field('rel_obj').column)
+        self.all().delete()
+        cursor = connection.cursor()
+        for type_id, join in _live_object_joins("t.%s" % qn(through_opts.get_field('obj').column)):
+            cursor.execute("INSERT INTO %s (%s, %s, %s) SELECT t.%s, %%s, COUNT(*) FROM %s t %s GROUP BY t.%s" % (
+                qn(opts.db_table), qn(opts.get_field('tag').column), qn(opts.get_field('type').column), qn(opts.get_field('count').column),
+                tag_col, qn(through_opts.db_table), join, tag_col,
+            ), [type_id, type_id])
+        transaction.commit_unless_managed()
+        tag_counts_changed.send(sender=self.model)
+
+
+class TagCount(models.Model):
+    """ The number of objects of a given type that are tagged with a tag. Maintained by signal handlers below. """
+    tag = models.ForeignKey(Tag, related_name='counts')
+    type = models.ForeignKey(polymorph.Type, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    
+    objects = TagCountManager()
+    
+    class Meta:
+        unique_together = ('tag', 'type')
+        
+    def __unicode__(self):
+        return u"%s, type=%s: %s" % (self.tag_id, self.type_id, self.count)
+
+
+class TagCooccurrenceManager(models.Manager):
+    def rebuild(self):
+        """ Recomputes all co-occurrence counts from the tag relation table, only assignments of existing objects are counted like in `TagCount`. """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        through_opts = get_tag_through()._meta
+        tag_col = qn(through_opts.get_field('rel_obj').column)
+        obj_col = qn(through_opts.get_field('obj').column)
+        self.all().delete()
+        cursor = connection.cursor()
+        for type_id, join in _live_object_joins("a.%s" % obj_col):
+            cursor.execute("INSERT INTO %s (%s, %s, %s, %s) SELECT a.%s, b.%s, %%s, COUNT(*) FROM %s a INNER JOIN %s b ON a.%s = b.%s AND a.%s <> b.%s %s GROUP BY a.%s, b.%s" % (
+                qn(opts.db_table), qn(opts.get_field('tag_a').column), qn(opts.get_field('tag_b').column), qn(opts.get_field('type').column), qn(opts.get_field('count').column),
+                tag_col, tag_col,
+                qn(through_opts.db_table), qn(through_opts.db_table), obj_col, obj_col, tag_col, tag_col,
+                join, tag_col, tag_col,
+            ), [type_id, type_id])
+        transaction.commit_unless_managed()
+
+
+class TagCooccurrence(models.Model):
+    """ The number of objects of a given type that are tagged with both `tag_a` and `tag_b`. Stored for both orders, maintained by signal handlers below. """
+    tag_a = models.ForeignKey(Tag, related_name='cooccurrences')
+    tag_b = models.ForeignKey(Tag, related_name='+')
+    type = models.ForeignKey(polymorph.Type, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    
+    objects = TagCooccurrenceManager()
+    
+    class Meta:
+        unique_together = ('tag_a', 'tag_b', 'type')
+        
+    def __unicode__(self):
+        return u"%s, %s, type=%s: %s" % (self.tag_a_id, self.tag_b_id, self.type_id, self.count)
+
+
+class TagSignatureBandManager(models.Manager):
+    def rebuild(self):
+        """ Recomputes the MinHash band hashes of all existing tagged objects. """
+        self.all().delete()
+        through = get_tag_through()
+        rows = []
+        for model in get_sub_models(Tagged, abstract=False):
+            assignments = through.objects.filter(obj__type=polymorph.Type.objects.get_for_model(model), obj__in=model._default_manager.values('pk'))
+            for identity_id, group in itertools.groupby(assignments.values_list('obj', 'rel_obj').order_by('obj').iterator(), key=itemgetter(0)):
+                rows.extend((identity_id, band, h) for band, h in minhash.band_hashes(set(tag_id for obj_id, tag_id in group)))
+                if len(rows) >= 1000:
+                    _insert_signature_bands(rows)
+                    rows = []
+        _insert_signature_bands(rows)
+        transaction.commit_unless_managed()
+
+
+class TagSignatureBand(models.Model):
+    """ A band hash of the MinHash signature of an object's tag set. Objects that share a band hash are candidates for similar objects. """
+    obj = models.ForeignKey(ObjectIdentity, related_name='+')
+    band = models.PositiveSmallIntegerField()
+    hash = models.IntegerField(db_index=True)
+    
+    objects = TagSignatureBandManager()
+    
+    class Meta:
+        unique_together = ('obj', 'band')
+        
+    def __unicode__(self):
+        return u"%s, band=%s: %s" % (self.obj_id, self.band, self.hash)
+
 
 class Tagged(polymorph.Object):
-    tags = polymorph.ReverseField(Tag, 'object_set', manager_class=TagFieldManager)    
+    tags = polymorph.ReverseField(Tag, 'object_set', manager_class=TagFieldManager, manager_class_decorator=resolve_tag_arguments)
     objects = TaggedManager()
     
     class Meta:
         abstract = True    
     
-    def similar_objects(self):
-        return UnionQuerySet(TaggedObject).filter(tags__in=self.tags).annotate(common_tag_count=models.Count('tags')).order_by('-common_tag_count')
+    def similar_objects(self, limit=10):
+        return get_similar_objects(self, limit=limit)
 
 ##### utilities #####
 
+def get_tag_through():
+    """ Returns the intermediary model of `Tag.object_set`, its table holds all tag assignments. """
+    return Tag._meta.get_field('object_set').rel.through
+
+def _cache_tag_name(tag):
+    # Only ids that are known to be committed are cached: outside of managed transactions every change is committed right away, 
+    # inside of them only reads before the first write can't see uncommitted tags.
+    if not transaction.is_managed() or not transaction.is_dirty():
+        tag_name_cache[tag.name] = tag.pk
+
+def _cached_tag(name):
+    pk = tag_name_cache.get(name)
+    if pk is None:
+        return None
+    tag = Tag(pk=pk, name=name)
+    tag._state.db = Tag.objects.db
+    return tag
+
 def get_tag(tag, create=False, str_pk=False):
     if isinstance(tag, Tag):
         return tag
@@ -93,21 +390,57 @@ def get_tag(tag, create=False, str_pk=False):
                 return Tag.objects.get(pk=int(tag))
             except ValueError:
                 pass
+        cached = _cached_tag(tag)
+        if cached:
+            return cached
         if create:
             tag, created = Tag.objects.get_or_create(name=tag)
-            return tag
         else:
-            return Tag.objects.get(name=tag)
+            tag = Tag.objects.get(name=tag)
+        _cache_tag_name(tag)
+        return tag
     if isinstance(tag, (int, long)):
         return Tag.objects.get(pk=tag)
     raise TypeError("Tag, str, unicode, int, or long instance expected")
 
+# stays below SQLite's limit of query parameters
+LOOKUP_CHUNK_SIZE = 500
+
+def _chunks(items):
+    items = list(items)
+    for i in xrange(0, len(items), LOOKUP_CHUNK_SIZE):
+        yield items[i:i + LOOKUP_CHUNK_SIZE]
+
+def _create_tags(names):
+    """ Inserts tags for all `names` with a single statement. If some of them exist by now, falls back to `get_or_create()` for each. """
+    opts = Tag._meta
+    qn = connection.ops.quote_name
+    sid = transaction.savepoint()
+    try:
+        cursor = connection.cursor()
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%%s)" % (qn(opts.db_table), qn(opts.get_field('name').column)), [(name,) for name in names])
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        for name in names:
+            Tag.objects.get_or_create(name=name)
+    transaction.commit_unless_managed()
+    tags = []
+    for chunk in _chunks(names):
+        tags.extend(Tag.objects.filter(name__in=chunk))
+    return tags
+
 def get_tags(tags, create=False, str_pk=False):
+    """
+    Returns a set of :class:`Tag` objects for `tags` (a tag string or a collection of tags, names, and ids). 
+    Names are resolved through `tag_name_cache`, the remaining names and ids are looked up with a single query (per 500 of them). 
+    If `create` is True, missing tags are inserted in bulk.
+    """
     if isinstance(tags, (str, unicode)):
         tags = parse_tags(tags)    
     tag_set = set()
     names = set()    
-    tag_lookups = set()
+    pks = set()
     for tag in tags:
         if isinstance(tag, Tag):
             tag_set.add(tag)
@@ -115,17 +448,382 @@ def get_tags(tags, create=False, str_pk=False):
                 tag.save()
         elif isinstance(tag, basestring):
             try:
-                tag_lookups.add(models.Q(pk=int(tag)))
+                pks.add(int(tag))
             except ValueError:
-                if create:
+                cached = _cached_tag(tag)
+                if cached:
+                    tag_set.add(cached)
+                else:
                     names.add(tag)
-                tag_lookups.add(models.Q(name=tag))
         elif isinstance(tag, (int, long)):
-            tag_lookups.add(models.Q(pk=tag))
-    if tag_lookups:
-        for tag in Tag.objects.filter(reduce_or(tag_lookups)):
+            pks.add(tag)
+    names, pks = list(names), list(pks)
+    found = set()
+    while names or pks:
+        name_chunk, names = names[:LOOKUP_CHUNK_SIZE], names[LOOKUP_CHUNK_SIZE:]
+        pk_chunk, pks = pks[:LOOKUP_CHUNK_SIZE - len(name_chunk)], pks[LOOKUP_CHUNK_SIZE - len(name_chunk):]
+        for tag in Tag.objects.filter(models.Q(name__in=name_chunk) | models.Q(pk__in=pk_chunk)):
+            _cache_tag_name(tag)
             tag_set.add(tag)
-        for name in names.difference(tag.name for tag in tag_set):
-            tag_set.add(Tag.objects.create(name=name))            
+            found.add(tag.name)
+        if create:
+            missing = [name for name in name_chunk if name not in found]
+            if missing:
+                for tag in _create_tags(missing):
+                    _cache_tag_name(tag)
+                    tag_set.add(tag)
     return tag_set
+
+def prefetch_tags(objects):
+    """ 
+    Loads the tags of `objects` (instances of any :class:`Tagged` models) with a single query over the tag relation table 
+    and attaches them, so that `obj.tags.all()` doesn't query the database. 
+    """
+    tags = defaultdict(list)
+    for chunk in _chunks(set(obj.pk for obj in objects)):
+        for row in get_tag_through().objects.filter(obj__in=chunk).select_related('rel_obj'):
+            tags[row.obj_id].append(row.rel_obj)
+    for obj in objects:
+        obj._prefetched_tags = sorted(tags.get(obj.pk, ()), key=lambda tag: tag.name)
+
+def iter_with_prefetched_tags(objects):
+    """ Yields `objects`, prefetching tags for 500 of them at a time. """
+    objects = iter(objects)
+    while True:
+        chunk = list(itertools.islice(objects, LOOKUP_CHUNK_SIZE))
+        if not chunk:
+            return
+        prefetch_tags(chunk)
+        for obj in chunk:
+            yield obj
+
+def _resolve_tag_names(tags):
+    # leaves tags and ids alone, so that no query is needed unless names are given
+    tags = list(tags)
+    names = set(tag for tag in tags if isinstance(tag, basestring))
+    if not names:
+        return tags
+    resolved = {}
+    for name in names:
+        cached = _cached_tag(name)
+        if cached:
+            resolved[name] = cached
+    for chunk in _chunks(names.difference(resolved)):
+        for tag in Tag.objects.filter(name__in=chunk):
+            _cache_tag_name(tag)
+            resolved[tag.name] = tag
+    missing = names.difference(resolved)
+    if missing:
+        raise Tag.DoesNotExist("Tag matching name=%s does not exist" % ", ".join(sorted(missing)))
+    return [resolved.get(tag, tag) if isinstance(tag, basestring) else tag for tag in tags]
+
+def _resolve_tag_ids(tags):
+    # strings are names, never ids
+    return [getattr(tag, 'pk', tag) for tag in _resolve_tag_names(tags)]
   
+def get_count_types(queryset):
+    """ 
+    Returns the types whose materialized tag counts describe `queryset`, or None if `queryset` is filtered 
+    (or a union of filtered querysets) and its tags have to be counted. 
+    """
+    if isinstance(queryset, UnionQuerySet):
+        querysets = queryset.querysets
+        if queryset.limits != (None, None):
+            return None
+    else:
+        querysets = [queryset]
+    types = []
+    for qs in querysets:
+        if isinstance(qs, EmptyQuerySet):
+            return None
+        query = qs.query
+        if query.where.children or query.having.children or query.low_mark or query.high_mark is not None:
+            return None
+        types.append(polymorph.Type.objects.get_for_model(qs.model))
+    return types
+
+
+##### materialized tag counts #####
+
+def _live_object_joins(identity_ref):
+    """ 
+    Yields `(type_id, sql)` for each concrete Tagged model, where `sql` joins the identity `i` and the row `o` of the object referenced 
+    by `identity_ref` if it is an existing object of that type. The join takes `type_id` as its only parameter.
+    """
+    qn = connection.ops.quote_name
+    identity_opts = ObjectIdentity._meta
+    for model in get_sub_models(Tagged, abstract=False):
+        opts = model._meta
+        yield polymorph.Type.objects.get_for_model(model).pk, "INNER JOIN %s i ON %s = i.%s AND i.%s = %%s INNER JOIN %s o ON o.%s = i.%s" % (
+            qn(identity_opts.db_table), identity_ref, qn(identity_opts.pk.column), qn(identity_opts.get_field('type').column),
+            qn(opts.db_table), qn(opts.pk.column), qn(identity_opts.pk.column),
+        )
+
+
+def update_tag_counts(tag_ids, identity_ids, delta):
+    """ Adds `delta` to the counts of each tag in `tag_ids` for each object in `identity_ids`. """
+    if not tag_ids or not identity_ids or not tagging_settings.MATERIALIZED_COUNTS:
+        return
+    type_counts = ObjectIdentity.objects.filter(pk__in=identity_ids).values_list('type').annotate(models.Count('pk')).order_by()
+    for type_id, n in type_counts:
+        counts = TagCount.objects.filter(tag__in=tag_ids, type=type_id)
+        if delta > 0:
+            existing = set(counts.values_list('tag_id', flat=True))
+            for tag_id in set(tag_ids).difference(existing):
+                TagCount.objects.create(tag_id=tag_id, type_id=type_id, count=delta * n)
+            counts = counts.filter(tag__in=existing)
+        counts.update(count=models.F('count') + delta * n)
+
+def get_tag_assignments(identity_ids):
+    """ Returns a dict that maps each of `identity_ids` to the set of its tag ids. """
+    assignments = dict((identity_id, set()) for identity_id in identity_ids)
+    for tag_id, identity_id in get_tag_through().objects.filter(obj__in=list(identity_ids)).values_list('rel_obj_id', 'obj_id'):
+        assignments[identity_id].add(tag_id)
+    return assignments
+
+def update_tag_cooccurrences(assignments, changed, delta):
+    """
+    Adds `delta` to the co-occurrence counts of all pairs of tags that involve a changed tag. 
+    `changed` maps identity ids to the added (or removed) tag ids, `assignments` maps them to all their tag ids, including the changed ones.
+    """
+    if not changed or not tagging_settings.MATERIALIZED_COOCCURRENCES:
+        return
+    types = dict(ObjectIdentity.objects.filter(pk__in=list(changed)).values_list('pk', 'type'))
+    deltas = defaultdict(int)
+    for identity_id, tag_ids in changed.iteritems():
+        type_id = types[identity_id]
+        for a in tag_ids:
+            for b in assignments.get(identity_id, ()):
+                if a == b:
+                    continue
+                deltas[a, b, type_id] += delta
+                if b not in tag_ids:
+                    deltas[b, a, type_id] += delta
+    apply_cooccurrence_deltas(deltas)
+    
+def apply_cooccurrence_deltas(deltas):
+    """ Adds `deltas[tag_a, tag_b, type_id]` to the respective co-occurrence counts, creating missing rows. """
+    # one update per (tag_a, type, delta)
+    groups = defaultdict(list)
+    for (a, b, type_id), n in deltas.iteritems():
+        groups[a, type_id, n].append(b)
+    for (a, type_id, n), tag_b_ids in groups.iteritems():
+        rows = TagCooccurrence.objects.filter(tag_a=a, tag_b__in=tag_b_ids, type=type_id)
+        if n > 0:
+            existing = set(rows.values_list('tag_b_id', flat=True))
+            for b in set(tag_b_ids).difference(existing):
+                TagCooccurrence.objects.create(tag_a_id=a, tag_b_id=b, type_id=type_id, count=n)
+            rows = rows.filter(tag_b__in=existing)
+        rows.update(count=models.F('count') + n)
+
+def apply_tag_count_deltas(tag_id, type_counts):
+    """ Adds `n` to the count of `tag_id` for each `(type_id, n)` in `type_counts`, creating missing rows. """
+    for type_id, n in type_counts:
+        if not TagCount.objects.filter(tag=tag_id, type=type_id).update(count=models.F('count') + n) and n > 0:
+            TagCount.objects.create(tag_id=tag_id, type_id=type_id, count=n)
+
+def change_tag_assignments(queryset, tag_id, delta):
+    """ 
+    Adds (`delta` = 1) or removes (`delta` = -1) `tag_id` to or from all objects in `queryset` with a single statement, 
+    and updates the materialized counts and co-occurrences with a few grouped queries. Does not send m2m_changed.
+    """
+    assert queryset.query.can_filter(), "Cannot change tags once a slice has been taken."
+    through = get_tag_through()
+    opts = through._meta
+    db = queryset.db
+    connection = connections[db]
+    qn = connection.ops.quote_name
+    tagged = through.objects.filter(rel_obj=tag_id).values('obj')
+    if delta > 0:
+        changed = queryset.exclude(pk__in=tagged)
+    else:
+        changed = queryset.filter(pk__in=tagged)
+    changed_ids = changed.values('pk')
+    if tagging_settings.MATERIALIZED_COUNTS:
+        type_counts = list(ObjectIdentity.objects.filter(pk__in=changed_ids).values_list('type').annotate(models.Count('pk')).order_by())
+        if not type_counts:
+            return
+        apply_tag_count_deltas(tag_id, [(type_id, delta * n) for type_id, n in type_counts])
+    if tagging_settings.MATERIALIZED_COOCCURRENCES:
+        deltas = defaultdict(int)
+        cooccurring = through.objects.filter(obj__in=changed_ids).exclude(rel_obj=tag_id).values_list('rel_obj', 'obj__type').annotate(models.Count('pk')).order_by()
+        for b, type_id, n in cooccurring:
+            deltas[tag_id, b, type_id] += delta * n
+            deltas[b, tag_id, type_id] += delta * n
+        apply_cooccurrence_deltas(deltas)
+    if tagging_settings.SIMILARITY_INDEX:
+        # the changed objects can't be selected once their tags have changed
+        changed_id_list = list(changed.values_list('pk', flat=True))
+    cursor = connection.cursor()
+    if delta > 0:
+        sql, params = changed.values_list('pk', flat=True).query.get_compiler(db).as_sql()
+        cursor.execute("INSERT INTO %s (%s, %s) SELECT %s, %%s FROM %s WHERE %s IN (%s)" % (
+            qn(opts.db_table), qn(opts.get_field('obj').column), qn(opts.get_field('rel_obj').column),
+            qn(ObjectIdentity._meta.pk.column), qn(ObjectIdentity._meta.db_table), qn(ObjectIdentity._meta.pk.column), sql,
+        ), [tag_id] + list(params))
+    else:
+        sql, params = queryset.values_list('pk', flat=True).query.get_compiler(db).as_sql()
+        cursor.execute("DELETE FROM %s WHERE %s = %%s AND %s IN (%s)" % (
+            qn(opts.db_table), qn(opts.get_field('rel_obj').column), qn(opts.get_field('obj').column), sql,
+        ), [tag_id] + list(params))
+    if tagging_settings.SIMILARITY_INDEX:
+        update_similarity_index(changed_id_list)
+    tag_counts_changed.send(sender=TagCount)
+
+##### similarity index #####
+
+def _insert_signature_bands(rows):
+    if not rows:
+        return
+    opts = TagSignatureBand._meta
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)" % (
+        qn(opts.db_table), qn(opts.get_field('obj').column), qn(opts.get_field('band').column), qn(opts.get_field('hash').column),
+    ), rows)
+
+def update_similarity_index(identity_ids):
+    """ Recomputes the MinHash band hashes of the objects in `identity_ids` from their current tags. """
+    if not identity_ids or not tagging_settings.SIMILARITY_INDEX:
+        return
+    for chunk in _chunks(identity_ids):
+        TagSignatureBand.objects.filter(obj__in=chunk).delete()
+        _insert_signature_bands([
+            (identity_id, band, h) for identity_id, tag_ids in get_tag_assignments(chunk).iteritems() for band, h in minhash.band_hashes(tag_ids)
+        ])
+    transaction.commit_unless_managed()
+    
+def get_tag_ids(obj):
+    return set(get_tag_through().objects.filter(obj=obj.pk).values_list('rel_obj', flat=True))
+
+def get_similarity_candidates(tag_ids):
+    """ Returns a values_list() queryset of the identity ids of all objects that share at least one band hash with `tag_ids`. """
+    bands = minhash.band_hashes(tag_ids)
+    if not bands:
+        return TagSignatureBand.objects.none().values_list('obj', flat=True)
+    q = reduce_or(models.Q(band=band, hash=h) for band, h in bands)
+    return TagSignatureBand.objects.filter(q).values_list('obj', flat=True).distinct()
+
+def get_similar_objects(obj, limit=10):
+    """
+    Returns up to `limit` tagged objects (of any model) ranked by the Jaccard similarity of their tags to the tags of `obj`, 
+    which is stored as their `similarity` attribute. With `SIMILARITY_INDEX`, only objects that share a MinHash band with `obj` are ranked, 
+    otherwise the `SIMILAR_OBJECT_CANDIDATES` (at least `limit`) objects with the most tags in common, selected with a grouped query.
+    """
+    tag_ids = get_tag_ids(obj)
+    if not tag_ids:
+        return []
+    if tagging_settings.SIMILARITY_INDEX:
+        candidates = get_similarity_candidates(tag_ids)
+    else:
+        candidates = get_tag_through().objects.filter(rel_obj__in=tag_ids).exclude(obj=obj.pk).values('obj').annotate(common_tag_count=models.Count('pk'))
+        candidates = candidates.order_by('-common_tag_count', 'obj')[:max(tagging_settings.SIMILAR_OBJECT_CANDIDATES, limit or 0)]
+        candidates = [row['obj'] for row in candidates]
+    candidates = [identity_id for identity_id in candidates if identity_id != obj.pk]
+    ranked = []
+    for chunk in _chunks(candidates):
+        ranked.extend((jaccard(tag_ids, other_tag_ids), identity_id) for identity_id, other_tag_ids in get_tag_assignments(chunk).iteritems())
+    if limit:
+        ranked = heapq.nlargest(limit, ranked)
+    else:
+        ranked.sort(reverse=True)
+    if not ranked:
+        return []
+    instances = dict((instance.pk, instance) for instance in ObjectIdentity.objects.filter(pk__in=[identity_id for similarity, identity_id in ranked]).instances())
+    result = []
+    for similarity, identity_id in ranked:
+        instance = instances.get(identity_id)
+        if instance is None:
+            # the object is gone, but its identity hasn't been deleted
+            continue
+        instance.similarity = similarity
+        result.append(instance)
+    return result
+
+def _group_assignments(assignments):
+    # [(tag_id, identity_id)] -> {identity_id: set(tag_ids)}
+    grouped = defaultdict(set)
+    for tag_id, identity_id in assignments:
+        grouped[identity_id].add(tag_id)
+    return grouped
+
+def _is_tag_through(model):
+    return model._meta.db_table == get_tag_through()._meta.db_table
+
+def _split_m2m_change(instance, model, pk_set):
+    # returns (tag_ids, identity_ids)
+    if issubclass(model, Tag):
+        return pk_set, [instance.pk]
+    return [instance.pk], pk_set
+
+def _m2m_changed(sender, instance, action, model, pk_set, **kwargs):
+    if not _is_tag_through(sender):
+        return
+    if tagging_settings.MATERIALIZED_COUNTS or tagging_settings.MATERIALIZED_COOCCURRENCES or tagging_settings.SIMILARITY_INDEX:
+        _update_materialized_tags(instance, action, model, pk_set)
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        tag_counts_changed.send(sender=TagCount)
+models.signals.m2m_changed.connect(_m2m_changed)
+
+def _update_materialized_tags(instance, action, model, pk_set):
+    through = get_tag_through()
+    if action == 'post_add':
+        tag_ids, identity_ids = _split_m2m_change(instance, model, pk_set)
+        update_tag_counts(tag_ids, identity_ids, 1)
+        if tagging_settings.MATERIALIZED_COOCCURRENCES and tag_ids:
+            update_tag_cooccurrences(get_tag_assignments(identity_ids), dict((identity_id, set(tag_ids)) for identity_id in identity_ids), 1)
+        if tag_ids:
+            update_similarity_index(identity_ids)
+    elif action in ('pre_remove', 'pre_clear'):
+        if action == 'pre_remove':
+            tag_ids, identity_ids = _split_m2m_change(instance, model, pk_set)
+            # only count assignments that actually exist
+            rows = through.objects.filter(rel_obj__in=tag_ids, obj__in=identity_ids)
+        elif issubclass(model, Tag):
+            rows = through.objects.filter(obj=instance.pk)
+        else:
+            rows = through.objects.filter(rel_obj=instance.pk)
+        instance._removed_tag_assignments = list(rows.values_list('rel_obj_id', 'obj_id'))
+        if tagging_settings.MATERIALIZED_COOCCURRENCES:
+            instance._tag_assignments = get_tag_assignments(set(obj_id for tag_id, obj_id in instance._removed_tag_assignments))
+    elif action in ('post_remove', 'post_clear'):
+        removed = getattr(instance, '_removed_tag_assignments', ())
+        if issubclass(model, Tag):
+            update_tag_counts([tag_id for tag_id, obj_id in removed], [instance.pk], -1)
+        else:
+            update_tag_counts([instance.pk], [obj_id for tag_id, obj_id in removed], -1)
+        update_tag_cooccurrences(getattr(instance, '_tag_assignments', {}), _group_assignments(removed), -1)
+        update_similarity_index(set(obj_id for tag_id, obj_id in removed))
+        instance._removed_tag_assignments = ()
+        instance._tag_assignments = {}
+
+def _pre_delete(sender, instance, **kwargs):
+    if not isinstance(instance, Tagged):
+        return
+    if tagging_settings.MATERIALIZED_COUNTS or tagging_settings.MATERIALIZED_COOCCURRENCES:
+        tag_ids = list(get_tag_through().objects.filter(obj=instance.pk).values_list('rel_obj_id', flat=True))
+        update_tag_counts(tag_ids, [instance.pk], -1)
+        update_tag_cooccurrences({instance.pk: set(tag_ids)}, {instance.pk: set(tag_ids)}, -1)
+    if tagging_settings.SIMILARITY_INDEX:
+        TagSignatureBand.objects.filter(obj=instance.pk).delete()
+models.signals.pre_delete.connect(_pre_delete)
+
+def _post_delete(sender, instance, **kwargs):
+    if isinstance(instance, Tagged):
+        tag_counts_changed.send(sender=TagCount)
+models.signals.post_delete.connect(_post_delete)
+
+def _tag_saved(sender, instance, created, **kwargs):
+    if created:
+        _cache_tag_name(instance)
+    else:
+        # the tag may have been renamed
+        tag_name_cache.clear()
+models.signals.post_save.connect(_tag_saved, sender=Tag)
+
+def _tag_deleted(sender, instance, **kwargs):
+    try:
+        del tag_name_cache[instance.name]
+    except KeyError:
+        pass
+models.signals.post_delete.connect(_tag_deleted, sender=Tag)
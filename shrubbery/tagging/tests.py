@@ -1,15 +1,17 @@
 import unittest
-from django.db import models, connection
+from django.conf import settings
+from django.db import models, connection, transaction
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
 
 from shrubbery.polymorph.models import Object, ObjectIdentity
 from shrubbery import polymorph
 from shrubbery.db.union import UnionQuerySet
 from shrubbery.db.virtual import VirtualModel
 from shrubbery.db.managers import Manager
-from shrubbery.tagging.models import Tag, Tagged, TagQ
+from shrubbery.tagging.models import Tag, Tagged, TagQ, TaggedUnionQuerySet, TagCount, TagCooccurrence, TagSignatureBand, tagging_settings, get_tags, get_tag, tag_name_cache, _create_tags
 from shrubbery.tagging import clouds
-from shrubbery.tagging.cooccurrences import cossim, jaccard
+from shrubbery.tagging.cooccurrences import cossim, jaccard, probability, Cooccurrences, CooccurrenceMatrix, StoredCooccurrences, get_cooccurrences
         
 class Comment(models.Model):    
     obj = polymorph.ForeignKey()
@@ -54,6 +56,19 @@ class C(A):
 
 
 class TaggingTest(unittest.TestCase):
+    def setUp(self):
+        tagging_settings.instance.MATERIALIZED_COUNTS = True
+        tagging_settings.instance.MATERIALIZED_COOCCURRENCES = True
+        tagging_settings.instance.SIMILARITY_INDEX = True
+        TagCount.objects.rebuild()
+        TagCooccurrence.objects.rebuild()
+        TagSignatureBand.objects.rebuild()
+        
+    def tearDown(self):
+        del tagging_settings.instance.MATERIALIZED_COUNTS
+        del tagging_settings.instance.MATERIALIZED_COOCCURRENCES
+        del tagging_settings.instance.SIMILARITY_INDEX
+    
     def assertResultsEqual(self, qs, res, order_by='pk'):
         if order_by:
             if isinstance(qs, UnionQuerySet):
@@ -64,6 +79,18 @@ class TaggingTest(unittest.TestCase):
         else:
             self.assertEqual(set(res), set(qs))
     
+    def assertCountsMaterialized(self, model):
+        live = dict((tag.name, tag._count) for tag in clouds.Cloud(queryset=model.objects.filter(pk__gt=0)).tags)
+        materialized = dict((tag.name, tag._count) for tag in clouds.Cloud(queryset=model).tags)
+        self.assertEqual(live, materialized)
+        
+    def assertCooccurrencesMaterialized(self, model):
+        live = CooccurrenceMatrix(model.objects.filter(pk__gt=0))
+        stored = StoredCooccurrences([polymorph.Type.objects.get_for_model(model)])
+        self.assertEqual(live.entries, stored.entries)
+        self.assertEqual(live.tag_counts, stored.tag_counts)
+        self.assertEqual(live.total, stored.total)
+    
     def get_tags(self, tags):
         return list(Tag.objects.filter(name__in=tags.upper()))
     
@@ -75,6 +102,192 @@ class TaggingTest(unittest.TestCase):
             names[index] = obj
         model.objects.create(**{name_field: "%s%s_%s" % (prefix, len(names), 'x')})
     
+    def test_cloud_cache(self):
+        self.assertEqual(list(clouds.Cloud(Post.objects.filter(pk=-1)).tags), [])
+        self.assertEqual(list(clouds.Cloud(Post.objects.none()).tags), [])
+        self.assertEqual(clouds.Cloud(Post.objects.none()).cloud, [])
+        tagging_settings.instance.MATERIALIZED_COUNTS = False
+        tagging_settings.instance.CLOUD_CACHE = get_cache('locmem://')
+        try:
+            tag = Tag.objects.create(name='cached')
+            post = Post.objects.create(title='cached')
+            counts = lambda: dict((t.name, t._count) for t in clouds.Cloud(queryset=Post).get_tags())
+            self.assertFalse('cached' in counts())
+            post.tags.add(tag)
+            self.assertEqual(counts()['cached'], 1)
+            Post.objects.filter(pk=post.pk).remove_tags(tag)
+            self.assertFalse('cached' in counts())
+            Post.objects.filter(pk=post.pk).add_tags(tag)
+            self.assertEqual(counts()['cached'], 1)
+            post.delete()
+            self.assertFalse('cached' in counts())
+            cl = clouds.Cloud(queryset=Post)
+            self.assertEqual(list(cl[:2].tags), list(cl.tags[:2]))
+        finally:
+            del tagging_settings.instance.CLOUD_CACHE
+            tagging_settings.instance.MATERIALIZED_COUNTS = True
+            TagCount.objects.rebuild()
+    
+    def test_bulk_tags(self):
+        u, v, w = [Tag.objects.create(name=name) for name in ('u', 'v', 'w')]
+        posts = [Post.objects.create(title='bulk%s' % i) for i in range(4)]
+        posts[0].tags = [u]
+        qs = Post.objects.filter(title__startswith='bulk')
+        tag_names = lambda post: sorted(tag.name for tag in post.tags.all())
+        
+        qs.add_tags('u', v)
+        self.assertEqual([tag_names(post) for post in posts], [['u', 'v']] * 4)
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        
+        qs.filter(pk__in=[posts[0].pk, posts[1].pk]).remove_tags(u)
+        self.assertEqual([tag_names(post) for post in posts], [['v'], ['v'], ['u', 'v'], ['u', 'v']])
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        
+        qs.set_tags({posts[0]: 'u, w', posts[1].pk: [], posts[2]: [v.pk, w]})
+        self.assertEqual([tag_names(post) for post in posts], [['u', 'w'], [], ['v', 'w'], ['u', 'v']])
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        
+        # strings are names, even if they are numeric
+        year = Tag.objects.create(name=str(u.pk))
+        qs.set_tags({posts[3]: [year.name, 'v']})
+        self.assertEqual(tag_names(posts[3]), sorted([year.name, 'v']))
+        qs.filter(pk=posts[1].pk).add_tags(year.name)
+        self.assertEqual(tag_names(posts[1]), [year.name])
+        
+        # unknown names raise, nothing is changed
+        self.assertRaises(Tag.DoesNotExist, qs.add_tags, 'u', 'unknown')
+        self.assertRaises(Tag.DoesNotExist, qs.remove_tags, 'unknown')
+        self.assertRaises(Tag.DoesNotExist, qs.set_tags, {posts[0]: 'w, unknown'})
+        self.assertEqual([tag_names(post) for post in posts], [['u', 'w'], [year.name], ['v', 'w'], sorted([year.name, 'v'])])
+        self.assertFalse(Tag.objects.filter(name='unknown').exists())
+        
+        # only existing assignments are deleted
+        through_table = Tag.object_set.through._meta.db_table
+        debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            del connection.queries[:]
+            qs.set_tags({posts[0]: 'u', posts[1]: [year]})
+            deletes = [query['sql'] for query in connection.queries if query['sql'].startswith('DELETE') and through_table in query['sql']]
+            self.assertEqual(len(deletes), 1)
+        finally:
+            settings.DEBUG = debug
+        self.assertEqual(tag_names(posts[0]), ['u'])
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        
+        qs.delete()
+        Tag.objects.filter(pk__in=[u.pk, v.pk, w.pk, year.pk]).delete()
+        
+    def assertSimilarityIndexUpToDate(self):
+        bands = lambda: sorted(TagSignatureBand.objects.values_list('obj', 'band', 'hash'))
+        maintained = bands()
+        TagSignatureBand.objects.rebuild()
+        self.assertEqual(maintained, bands())
+    
+    def test_similar_objects(self):
+        s1, s2, s3, s4, s5 = [Tag.objects.create(name='s%s' % i) for i in range(1, 6)]
+        posts = [Post.objects.create(title='similar%s' % i) for i in range(4)]
+        item = Item.objects.create(name='similar')
+        posts[0].tags = [s1, s2, s3]
+        posts[1].tags = [s1, s2]
+        posts[2].tags = [s4, s5]
+        item.tags = [s1, s2, s3]
+        self.assertSimilarityIndexUpToDate()
+        
+        similar = posts[0].similar_objects()
+        self.assertEqual(similar[0], item)
+        self.assertEqual(similar[0].similarity, 1.0)
+        self.assertFalse(posts[0] in similar)
+        self.assertFalse(posts[2] in similar)
+        self.assertEqual(list(Post.objects.with_similar_tags(posts[3])), [])
+        self.assertFalse(posts[2] in Post.objects.with_similar_tags(posts[0]))
+        
+        # without the index, only the objects with the most tags in common are ranked
+        tagging_settings.instance.SIMILARITY_INDEX = False
+        tagging_settings.instance.SIMILAR_OBJECT_CANDIDATES = 1
+        try:
+            self.assertEqual([(o, o.similarity) for o in posts[0].similar_objects(limit=5)], [(item, 1.0), (posts[1], 2 / 3.0)])
+            self.assertEqual(posts[0].similar_objects(limit=0), [item])
+        finally:
+            del tagging_settings.instance.SIMILAR_OBJECT_CANDIDATES
+            tagging_settings.instance.SIMILARITY_INDEX = True
+        
+        posts[1].tags.add(s3)
+        posts[2].tags.clear()
+        Post.objects.filter(pk=posts[3].pk).add_tags(s1, s2, s3)
+        self.assertSimilarityIndexUpToDate()
+        self.assertEqual(set(obj.pk for obj in posts[0].similar_objects()), set([posts[1].pk, posts[3].pk, item.pk]))
+        self.assertEqual(list(Post.objects.with_similar_tags(posts[0]).order_by('pk')), [posts[0], posts[1], posts[3]])
+        
+        # objects whose rows are gone are skipped
+        connection.cursor().execute("DELETE FROM %s WHERE %s = %%s" % (Post._meta.db_table, Post._meta.pk.column), [posts[1].pk])
+        self.assertEqual(set(obj.pk for obj in posts[0].similar_objects()), set([posts[3].pk, item.pk]))
+        TagSignatureBand.objects.rebuild()
+        self.assertFalse(TagSignatureBand.objects.filter(obj=posts[1].pk).exists())
+        ObjectIdentity.objects.filter(pk=posts[1].pk).delete()
+        
+        posts[3].delete()
+        self.assertFalse(TagSignatureBand.objects.filter(obj=posts[3].pk).exists())
+        Post.objects.filter(title__startswith='similar').delete()
+        item.delete()
+        self.assertSimilarityIndexUpToDate()
+        Tag.objects.filter(name__startswith='s').delete()
+        
+    def test_get_tags(self):
+        existing = Tag.objects.create(name='t1')
+        tag_name_cache.clear()
+        tags = get_tags(['t1', 't2', 't3', existing.pk], create=True)
+        self.assertEqual(sorted(tag.name for tag in tags), ['t1', 't2', 't3'])
+        self.assertEqual(Tag.objects.filter(name__in=['t1', 't2', 't3']).count(), 3)
+        for tag in tags:
+            self.assertEqual(tag_name_cache[tag.name], tag.pk)
+        self.assertEqual(get_tags('t2, t3, t4'), set(tag for tag in tags if tag.name != 't1'))
+        self.assertEqual(get_tag('t2'), Tag.objects.get(name='t2'))
+        # concurrently created names
+        self.assertEqual(sorted(tag.name for tag in _create_tags(['t0', 't1', 't6'])), ['t0', 't1', 't6'])
+        Tag.objects.filter(name__in=['t0', 't6']).delete()
+        
+        post = Post.objects.create(title='t')
+        post.tags.add('t1', 't2')
+        self.assertEqual(sorted(tag.name for tag in post.tags.all()), ['t1', 't2'])
+        post.tags.remove('t1')
+        self.assertEqual([tag.name for tag in post.tags.all()], ['t2'])
+        self.assertRaises(Tag.DoesNotExist, post.tags.add, 't1', 'missing')
+        self.assertRaises(Tag.DoesNotExist, post.tags.remove, 'missing')
+        self.assertEqual([tag.name for tag in post.tags.all()], ['t2'])
+        post.tags = 't1, t2, t3'
+        self.assertEqual(sorted(tag.name for tag in post.tags.all()), ['t1', 't2', 't3'])
+        post.tags.assign([Tag.objects.get(name='t3'), existing.pk])
+        self.assertEqual(sorted(tag.name for tag in post.tags.all()), ['t1', 't3'])
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        post.delete()
+        
+        t2 = Tag.objects.get(name='t2')
+        t2.name = 't5'
+        t2.save()
+        self.assertEqual([tag.name for tag in get_tags(['t2', 't5'])], ['t5'])
+        Tag.objects.filter(name__in=['t1', 't3', 't5']).delete()
+        self.assertFalse('t1' in tag_name_cache)
+        self.assertEqual(get_tags(['t1', 't3']), set())
+        
+        # tags created in a transaction that is rolled back are not cached
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            Tag.objects.create(name='t7')
+            get_tags(['t7', 't8'], create=True)
+            self.assertEqual(get_tag('t7').name, 't7')
+            self.assertFalse('t7' in tag_name_cache or 't8' in tag_name_cache)
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+        self.assertEqual(get_tags(['t7', 't8']), set())
+        self.assertRaises(Tag.DoesNotExist, get_tag, 't7')
+        
     def test_m2m(self):
         a, b, c, d, e, f, g, h, x = [Tag.objects.create(name=tag) for tag in ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'X')]
         
@@ -91,6 +304,14 @@ class TaggingTest(unittest.TestCase):
         self.assertResultsEqual(Item.objects.filter(tags=b), b_items)
         self.assertResultsEqual(b.object_set.coerce(Item), b_items)
         
+        for objects in (Post.objects.prefetch_tags().order_by('pk')[:4], TaggedUnionQuerySet(Post, Item).prefetch_tags()):
+            objects = list(objects)
+            self.assertTrue(all(obj.tags.all()._result_cache is not None for obj in objects))
+            self.assertEqual([list(obj.tags.all()) for obj in objects], [list(obj.tags.filter(pk__gt=0)) for obj in objects])
+        objects[0].tags.add(x)
+        self.assertTrue(x in objects[0].tags.all())
+        objects[0].tags.remove(x)
+        
         #ids = [obj.id for obj in items + posts]
         #self.assertResultsEqual(Tagged.objects.instances(), items + posts)
         #self.assertResultsEqual(Tagged.objects.all(), ids)
@@ -129,11 +350,43 @@ class TaggingTest(unittest.TestCase):
             'log': clouds.Annotation.LOGARITHMIC(steps=range(1,4)),
         })
         print cl
-        print cl.kmeans(3)
+        self.assertEqual([(tag.name, tag.count, tag.log) for tag in cl], [
+            ('A', 4, 3), ('B', 3, 2), ('C', 3, 2), ('D', 2, 2), ('E', 2, 2), ('F', 2, 2), ('G', 1, 1), ('H', 6, 3),
+        ])
+        names = lambda clusters: [sorted(tag.name for tag in cluster) for cluster in clusters]
+        self.assertEqual(names(cl.kmeans(3, optimal=True)), [['D', 'E', 'F', 'G'], ['A', 'B', 'C'], ['H']])
+        self.assertEqual(names(cl.kmeans(3)), names(cl.kmeans(3, optimal=True)))
+        self.assertEqual(sum(map(len, cl.kmeans(3, metric=lambda a, b: abs(a - b)))), len(cl.cloud))
         print cl.cache_key
         
+        self.assertEqual(CooccurrenceMatrix(Post.objects.filter(pk__lt=0)).total, 0)
+        self.assertRaises(TypeError, Cooccurrences)
+        matrix = CooccurrenceMatrix(Post)
+        # totals count tagged objects only
+        tagged_count = Post.objects.filter(tags__isnull=False).distinct().count()
+        self.assertTrue(tagged_count < Post.objects.count())
+        self.assertEqual(matrix.total, tagged_count)
+        self.assertEqual(StoredCooccurrences([polymorph.Type.objects.get_for_model(Post)]).total, tagged_count)
+        self.assertTrue(isinstance(get_cooccurrences(Post), StoredCooccurrences))
+        self.assertTrue(isinstance(get_cooccurrences(Post.objects.filter(pk__gt=0)), CooccurrenceMatrix))
+        self.assertEqual(sorted(StoredCooccurrences([polymorph.Type.objects.get_for_model(Post)]).pairs()), sorted(matrix.pairs()))
+        pairs = dict(((x, y), value) for x, y, value in matrix.pairs('jaccard'))
         for t in Tag.objects.all():
             print b, t, cossim(b, t, Post), jaccard(b, t, Post)
+            tagged_b, tagged_t = set(Post.objects.filter(tags=b)), set(Post.objects.filter(tags=t))
+            if tagged_b | tagged_t:
+                self.assertAlmostEqual(jaccard(b, t, Post), len(tagged_b & tagged_t) / float(len(tagged_b | tagged_t)))
+            if b != t:
+                self.assertAlmostEqual(pairs.get((b.pk, t.pk), 0), jaccard(b, t, Post))
+            common_tags = set(tag for post in tagged_b & tagged_t for tag in post.tags.all()).difference([b, t])
+            v_b = [len(tagged_b & set(Post.objects.filter(tags=u))) for u in common_tags]
+            v_t = [len(tagged_t & set(Post.objects.filter(tags=u))) for u in common_tags]
+            p = sum(x * y for x, y in zip(v_b, v_t))
+            self.assertAlmostEqual(cossim(b, t, Post), p and p / (sum(x * x for x in v_b) * sum(y * y for y in v_t)) ** 0.5)
+            self.assertAlmostEqual(cossim(b, t, Post.objects.filter(pk__gt=0)), cossim(b, t, Post))
+            if tagged_t:
+                self.assertAlmostEqual(probability(b, given=t, queryset=Post), len(tagged_b & tagged_t) / float(len(tagged_t)))
+            self.assertEqual(matrix.count(t), len(tagged_t))
         
         print Post.objects.tags()
         print Item.objects.tags()
@@ -144,4 +397,31 @@ class TaggingTest(unittest.TestCase):
         
         print str(a.object_set.coerce(Item).query)
         print a.object_set.coerce(Item)
+
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        self.assertCountsMaterialized(Item)
+        self.assertCooccurrencesMaterialized(Item)
+        self.assertEqual(sum(tag._count for tag in clouds.Cloud().tags), Tag.object_set.through.objects.count())
+        posts[1].tags.remove(b, x)
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        posts[2].tags.clear()
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
+        e.object_set.add(items[0].id)
+        self.assertCountsMaterialized(Item)
+        self.assertCooccurrencesMaterialized(Item)
+        a.object_set.clear()
+        self.assertCountsMaterialized(Item)
+        self.assertCooccurrencesMaterialized(Item)
+        posts[3].delete()
+        self.assertCountsMaterialized(Post)
+        self.assertCooccurrencesMaterialized(Post)
         
+        # rebuilding from scratch agrees with the maintained counts
+        maintained = lambda model: sorted(model.objects.filter(count__gt=0).values_list(*[f.attname for f in model._meta.fields if f.name != 'id']))
+        for model in (TagCount, TagCooccurrence):
+            rows = maintained(model)
+            model.objects.rebuild()
+            self.assertEqual(rows, maintained(model))
@@ -2,8 +2,9 @@ import re
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 
-from shrubbery.tagging.models import Tag, TagQ, get_tags
+from shrubbery.tagging.models import Tag, TagQ, get_tags, get_count_types, tagging_settings
 from shrubbery.tagging.clouds import Cloud
+from shrubbery.tagging.cooccurrences import StoredCooccurrences
 from shrubbery.views import GenericView, ListView
 from shrubbery.db.utils import get_query_set
 
@@ -21,6 +22,8 @@ class TaggedListView(ListView):
         tags = self.get_query_tags(request).union(self.implicit_tags)
         if tags:
             qs = qs.complex_filter(TagQ.all(*tags))
+        if hasattr(qs, 'prefetch_tags'):
+            qs = qs.prefetch_tags()
         return qs
         
     def smart_split_tags(self, tags):
@@ -52,9 +55,21 @@ class TaggedListView(ListView):
             'selected_tags': selected_tags,
             'related_tags': related_tags,
             'common_tags': common_tags,
-            'drilldown_tags': related_tags.exclude(pk__in=common_tags.values('pk').query),
+            'drilldown_tags': self.get_drilldown_tags(request, related_tags, common_tags),
         })
         return context
+        
+    def get_drilldown_tags(self, request, related_tags, common_tags):
+        tags = self.get_query_tags(request).union(self.implicit_tags)
+        if len(tags) == 1 and tagging_settings.MATERIALIZED_COOCCURRENCES and tagging_settings.MATERIALIZED_COUNTS and not request.view_context.data.get('search_query'):
+            # read the drilldown directly from the stored co-occurrences of the single selected tag
+            types = get_count_types(self.queryset)
+            if types is not None:
+                tag = iter(tags).next()
+                cooccurrences = StoredCooccurrences(types, tags=[tag])
+                count = cooccurrences.count(tag)
+                return Tag.objects.filter(pk__in=[tag_id for tag_id, n in cooccurrences.row(tag).iteritems() if n < count])
+        return related_tags.exclude(pk__in=common_tags.values('pk').query)
 
 
 class TaggedObjectDetailView(GenericView):
@@ -1,4 +1,6 @@
 import operator
+import threading
+from collections import OrderedDict
 
 from django.template import Context, RequestContext, Template
 from django.template.loader import select_template
@@ -47,6 +49,47 @@ def class_property(func):
     return ClassProperty(func)
 
 
+class LRUCache(object):
+    """ A thread-safe mapping that keeps only the `size` most recently used items. """
+    def __init__(self, size=100):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+            
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+            
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+                
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+            
+    def __contains__(self, key):
+        return key in self.data
+        
+    def __len__(self):
+        return len(self.data)
+        
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
 def force_iter(x):
     if isinstance(x, basestring):
         return iter((x,))